@@ -0,0 +1,168 @@
+"""
+Acquisition.py - incremental acquisition from the TDT RP2.1
+
+The RP2.1 circuit (startle2.rco) records both input channels into the
+'Data_out1' and 'Data_out2' buffers, and reports how far it has got in the
+'Index1' and 'Index2' tags. Rather than spinning on the index tags and then
+reading the whole trace at once, AcquisitionEngine polls at a bounded rate and
+drains whatever new data is available into a preallocated ring buffer.
+Waiting for the output task to finish is done the same way. A channel can
+also be filtered as it comes in (setFilter), with the filter state carried
+from one poll to the next.
+
+The processor only needs GetTagVal and ReadTagV, so the engine runs against
+the simulated devices in SimulatedDevices.py as well as the real hardware.
+"""
+# Paul B. Manis, Ph.D.
+# UNC Chapel Hill
+# Department of Otolaryngology/Head and Neck Surgery
+# Supported by NIH Grants DC000425-22 and DC004551-07 to PBM.
+#
+"""
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+import numpy as np
+
+POLL_INTERVAL = 0.005 # seconds between polls of the hardware
+
+class RingBuffer(object):
+    """ A preallocated (nchannels, size) float32 ring buffer. write appends
+        to each channel; data returns the last count points, oldest first. """
+    def __init__(self, size, nchannels=2):
+        self.buf = np.zeros((nchannels, size), dtype='float32')
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        self.head = np.zeros(self.buf.shape[0], dtype=int) # total points written per channel
+
+    def resize(self, size):
+        if size != self.size:
+            self.buf = np.zeros((self.buf.shape[0], size), dtype='float32')
+            self.size = size
+        self.reset()
+
+    def write(self, chan, data):
+        data = np.asarray(data, dtype='float32')
+        n = data.shape[0]
+        if n > self.size: # only the last size points can be kept
+            data = data[n-self.size:]
+            self.head[chan] += n - self.size
+            n = self.size
+        j = self.head[chan] % self.size
+        k = min(n, self.size - j)
+        self.buf[chan, j:j+k] = data[0:k]
+        self.buf[chan, 0:n-k] = data[k:]
+        self.head[chan] += n
+
+    def count(self, chan=None):
+        if chan is None:
+            return int(min(self.head))
+        return int(self.head[chan])
+
+    def data(self, chan):
+        """ the points held for this channel, in order (a view when they do not wrap) """
+        n = min(self.head[chan], self.size)
+        j = self.head[chan] % self.size
+        if self.head[chan] <= self.size:
+            return self.buf[chan, 0:n]
+        return np.concatenate((self.buf[chan, j:], self.buf[chan, 0:j]))
+
+
+class AcquisitionEngine(object):
+    def __init__(self, processor, datatags=('Data_out1', 'Data_out2'),
+                 indextags=('Index1', 'Index2'), pollinterval=POLL_INTERVAL):
+        self.processor = processor
+        self.datatags = datatags
+        self.indextags = indextags
+        self.pollinterval = pollinterval
+        self.ring = RingBuffer(1, len(datatags))
+        self.filters = {} # channel -> StreamingFilter applied as the data come in
+        self.filtered = RingBuffer(1, len(datatags))
+        self.npoints = 0
+        self.npolls = 0
+
+    def setFilter(self, chan, filt):
+        """ filter the data of chan as they are drained (filt is a
+            Utility.StreamingFilter; None removes it). The raw data are kept
+            as well; the filtered data are in filteredData(chan). """
+        if filt is None:
+            self.filters.pop(chan, None)
+        else:
+            self.filters[chan] = filt
+
+    def start(self, npoints):
+        """ prepare to collect npoints on each channel """
+        self.npoints = int(npoints)
+        self.ring.resize(self.npoints)
+        if len(self.filters) > 0:
+            self.filtered.resize(self.npoints)
+        for filt in self.filters.values():
+            filt.reset()
+        self.npolls = 0
+
+    def waitFor(self, done, stop=None, timeout=None, drain=False):
+        """ poll done() at a bounded rate until it is True. Returns False if
+            stop() became True, or the timeout (seconds) passed, first.
+            With drain=True, new input data are collected while waiting. """
+        t0 = time.time()
+        while not done():
+            if stop is not None and stop():
+                return False
+            if timeout is not None and (time.time() - t0) > timeout:
+                return False
+            if drain:
+                self.drain()
+            time.sleep(self.pollinterval)
+        return True
+
+    def acquire(self, npoints=None, stop=None, timeout=None):
+        """ collect the data on each channel (npoints, or as set by start).
+            Returns a list of arrays, one per channel, or None if stopped
+            (or timed out) before the data were in. The arrays are views of the
+            ring buffer, valid until the next acquisition. """
+        if npoints is not None:
+            self.start(npoints)
+        t0 = time.time()
+        while self.ring.count() < self.npoints:
+            if stop is not None and stop():
+                return None
+            if timeout is not None and (time.time() - t0) > timeout:
+                return None
+            self.drain()
+            if self.ring.count() < self.npoints:
+                time.sleep(self.pollinterval) # bounded polling rate
+        return [self.ring.data(i) for i in range(0, len(self.datatags))]
+
+    def drain(self):
+        """ read any new points from the processor into the ring buffer.
+            Returns the number of points read. """
+        nread = 0
+        self.npolls += 1
+        for i in range(0, len(self.datatags)):
+            have = self.ring.count(i)
+            index = min(int(self.processor.GetTagVal(self.indextags[i])), self.npoints)
+            if index > have:
+                data = self.processor.ReadTagV(self.datatags[i], have, index - have)
+                self.ring.write(i, data)
+                if i in self.filters:
+                    self.filtered.write(i, self.filters[i].filter(np.asarray(data, dtype=float)))
+                nread += index - have
+        return nread
+
+    def filteredData(self, chan):
+        """ the filtered data for chan, collected so far (see setFilter) """
+        return self.filtered.data(chan)
@@ -0,0 +1,120 @@
+"""
+AnalysisWorker.py - analysis in the background, off the GUI thread
+
+Reading a session and analyzing it run in a QThread, so the window stays live.
+The work is a function called as func(check, *args); it calls check(message)
+between steps, which reports progress and raises Cancelled if the job has been
+cancelled. The result is delivered back to the GUI thread through a Qt signal.
+
+Only the latest job matters: submitting a new one (another file, a changed
+filter corner) cancels the one running, whose results are then dropped, rather
+than waiting for it to finish.
+"""
+# Paul B. Manis, Ph.D.
+# UNC Chapel Hill
+# Department of Otolaryngology/Head and Neck Surgery
+# Supported by NIH Grants DC000425-22 and DC004551-07 to PBM.
+#
+"""
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from PyQt4 import QtCore
+
+class Cancelled(Exception):
+    pass
+
+class AnalysisJob(QtCore.QThread):
+    progress = QtCore.pyqtSignal(str)
+    done = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, func, args=(), parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check(self, message=None):
+        """ called by the work between steps """
+        if self.cancelled:
+            raise Cancelled
+        if message is not None:
+            self.progress.emit(message)
+
+    def run(self):
+        try:
+            result = self.func(self.check, *self.args)
+        except Cancelled:
+            return
+        except Exception, e:
+            if not self.cancelled:
+                self.failed.emit("%s: %s" % (type(e).__name__, e))
+            return
+        if not self.cancelled:
+            self.done.emit(result)
+
+
+class AnalysisWorker(QtCore.QObject):
+    """ runs one job at a time in the background; the callbacks (done(result),
+        progress(message), failed(message)) are called in the GUI thread, and
+        only for the current job """
+    def __init__(self, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.current = None
+        self.jobs = [] # started and not finished (including cancelled ones)
+
+    def submit(self, func, args=(), done=None, progress=None, failed=None):
+        self.cancel()
+        job = AnalysisJob(func, args, self)
+        if done is not None:
+            job.done.connect(lambda result, job=job: self._deliver(job, done, result))
+        if progress is not None:
+            job.progress.connect(lambda message, job=job: self._deliver(job, progress, str(message)))
+        if failed is not None:
+            job.failed.connect(lambda message, job=job: self._deliver(job, failed, str(message)))
+        job.finished.connect(lambda job=job: self._finished(job))
+        self.jobs.append(job)
+        self.current = job
+        job.start()
+        return job
+
+    def _deliver(self, job, callback, value):
+        if job is self.current and not job.cancelled: # anything else is stale
+            callback(value)
+
+    def _finished(self, job):
+        if job in self.jobs:
+            self.jobs.remove(job)
+        if job is self.current:
+            self.current = None
+        job.deleteLater()
+
+    def cancel(self):
+        """ cancel the current job (it stops at its next step) """
+        if self.current is not None:
+            self.current.cancel()
+            self.current = None
+
+    def busy(self):
+        return self.current is not None
+
+    def wait(self):
+        """ cancel and wait for all the jobs, e.g., before quitting """
+        self.cancel()
+        for job in list(self.jobs):
+            job.wait()
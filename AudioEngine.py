@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+AudioEngine.py - full-duplex stimulation and recording on the system sound card
+
+DuplexEngine plays a stereo stimulus and records both input channels in the
+same PortAudio stream, driven by the stream callback, so the input is sample
+aligned with the output. The output to input delay of the sound card (the
+converters and the driver buffers) is removed from the recording; it is
+measured once by playing a chirp with the outputs wired back to the inputs
+(calibrate), and kept in a small config file. Until the rig is calibrated,
+the latency PortAudio reports is used instead.
+
+usage: python AudioEngine.py [samplefreq]
+    with the outputs connected to the inputs, measures and saves the latency
+"""
+# Paul B. Manis, Ph.D.
+# UNC Chapel Hill
+# Department of Otolaryngology/Head and Neck Surgery
+# Supported by NIH Grants DC000425-22 and DC004551-07 to PBM.
+#
+"""
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys, threading
+import ConfigParser
+import numpy as np
+from Acquisition import POLL_INTERVAL
+
+LATENCY_FILE = 'audiolatency.cfg' # measured loopback latency for this machine
+
+class CalibrationError(Exception):
+    pass
+
+# read and write the measured latency (in frames at samplefreq)
+def readLatency(filename=LATENCY_FILE, samplefreq=44100.0):
+    config = ConfigParser.RawConfigParser()
+    if len(config.read(filename)) == 0 or not config.has_section('Audio'):
+        return None
+    if config.getfloat('Audio', 'samplefreq') != float(samplefreq):
+        return None # measured at another rate
+    return config.getint('Audio', 'latency')
+
+def saveLatency(latency, samplefreq, filename=LATENCY_FILE):
+    config = ConfigParser.RawConfigParser()
+    config.add_section('Audio')
+    config.set('Audio', 'samplefreq', float(samplefreq))
+    config.set('Audio', 'latency', int(latency))
+    configfile = open(filename, 'wb')
+    config.write(configfile)
+    configfile.close()
+
+
+class DuplexEngine(object):
+    """ pyaudio is the module, audio a pyaudio.PyAudio instance. latency is the
+        output to input delay in frames (None: use the latency the stream reports). """
+    def __init__(self, pyaudio, audio, samplefreq, channels=2, chunk=1024, latency=None):
+        self.pyaudio = pyaudio
+        self.audio = audio
+        self.samplefreq = samplefreq
+        self.channels = channels
+        self.chunk = chunk
+        self.latency = latency
+        self.stream = None
+        self.done = threading.Event()
+        self.status = 0 # callback status flags (over/underflows) seen in the last play
+        self.position = 0
+        self.nrec = 0
+
+    def open(self):
+        if self.stream is not None:
+            return
+        self.stream = self.audio.open(format=self.pyaudio.paFloat32,
+                        channels=self.channels,
+                        rate=int(self.samplefreq),
+                        output=True,
+                        input=True,
+                        frames_per_buffer=self.chunk,
+                        stream_callback=self._callback,
+                        start=False)
+        if self.latency is None:
+            self.latency = int(round((self.stream.get_input_latency() +
+                                      self.stream.get_output_latency())*self.samplefreq))
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        """ runs in the PortAudio thread: store the input, hand back the next output block """
+        i = self.position
+        n = max(0, min(frame_count, self.nrec - i))
+        if n > 0:
+            self.rec[i:i+n] = np.frombuffer(in_data, dtype='float32',
+                                            count=n*self.channels).reshape(n, self.channels)
+        self.status |= status
+        out = self.out[i:i+frame_count]
+        if out.shape[0] < frame_count: # the last block: pad with silence
+            out = np.concatenate((out, np.zeros((frame_count - out.shape[0], self.channels),
+                                                dtype='float32')))
+        self.position = i + frame_count
+        if self.position >= self.nrec:
+            self.done.set()
+            return (out.tostring(), self.pyaudio.paComplete)
+        return (out.tostring(), self.pyaudio.paContinue)
+
+    def play(self, data, stop=None):
+        """ play data, a (frames, channels) float32 array, recording the inputs
+            at the same time. Returns the input, (frames, channels) and aligned
+            with data, or None if stop() became True first. """
+        if stop is not None and stop():
+            return None
+        self.open()
+        nframes = data.shape[0]
+        self.nrec = nframes + self.latency # the input lags the output by the latency
+        self.out = np.zeros((self.nrec, self.channels), dtype='float32')
+        self.out[0:nframes] = data
+        self.rec = np.zeros((self.nrec, self.channels), dtype='float32')
+        self.position = 0
+        self.status = 0
+        self.done.clear()
+        self.stream.start_stream()
+        while not self.done.wait(POLL_INTERVAL):
+            if stop is not None and stop():
+                self.stream.stop_stream()
+                return None
+        self.stream.stop_stream() # lets the last blocks play out; ready for the next start
+        return self.rec[self.latency:]
+
+    def calibrate(self, duration=0.02, lead=0.05, tail=0.5, repeats=3):
+        """ measure the output to input latency with the outputs connected to the
+            inputs: play a chirp and find its delay in the input by cross
+            correlation. Sets and returns the latency in frames. """
+        sf = float(self.samplefreq)
+        t = np.arange(int(duration*sf))/sf
+        f0 = 500.0
+        f1 = min(10000.0, 0.4*sf)
+        probe = 0.5*np.sin(2*np.pi*(f0*t + 0.5*(f1 - f0)/duration*t**2))*np.hanning(len(t))
+        nlead = int(lead*sf)
+        data = np.zeros((nlead + len(probe) + int(tail*sf), self.channels), dtype='float32')
+        data[nlead:nlead+len(probe), :] = probe[:, np.newaxis]
+        self.open()
+        saved = self.latency
+        self.latency = 0 # record exactly what comes back
+        lags = []
+        try:
+            for r in range(0, repeats):
+                lags.append(findLag(data[:, 0], self.play(data)))
+        finally:
+            self.latency = saved
+        self.latency = int(np.median(lags))
+        return self.latency
+
+
+def findLag(out, rec, minsnr=10.0):
+    """ delay (frames) of out in the input channels of rec, by cross correlation;
+        the channel with the clearest peak is used. """
+    n = len(out) + rec.shape[0]
+    nfft = 1 << int(np.ceil(np.log2(n)))
+    fout = np.conj(np.fft.rfft(out, nfft))
+    best = None
+    for ch in range(0, rec.shape[1]):
+        xc = np.abs(np.fft.irfft(np.fft.rfft(rec[:, ch], nfft)*fout, nfft)[0:rec.shape[0]])
+        lag = int(np.argmax(xc))
+        snr = xc[lag]/(np.median(xc) + 1e-12)
+        if snr >= minsnr and (best is None or snr > best[1]):
+            best = (lag, snr)
+    if best is None:
+        raise CalibrationError("No loopback signal found: connect the outputs to the inputs")
+    return best[0]
+
+
+if __name__ == "__main__":
+    import pyaudio
+    samplefreq = 44100.0
+    if len(sys.argv) > 1:
+        samplefreq = float(sys.argv[1])
+    audio = pyaudio.PyAudio()
+    engine = DuplexEngine(pyaudio, audio, samplefreq)
+    try:
+        engine.open()
+        print "Reported latency: %d frames (%.2f ms)" % (engine.latency, 1000.0*engine.latency/samplefreq)
+        latency = engine.calibrate()
+        print "Measured latency: %d frames (%.2f ms)" % (latency, 1000.0*latency/samplefreq)
+        saveLatency(latency, samplefreq)
+        print "Saved in %s" % (LATENCY_FILE)
+    finally:
+        engine.close()
+        audio.terminate()
@@ -0,0 +1,484 @@
+"""
+Hardware.py - output, attenuator and acquisition backends for PySounds
+
+Each backend presents the same interface to PySounds:
+    open()      connect to the devices: raises HardwareNotFound if they (or their
+                drivers) are not there, and HardwareError if they are there but
+                cannot be used
+    startSession(), endSession()
+                keep the devices open and configured between trials (a run);
+                each play then only re-arms buffers and triggers
+    setAttens(attenl, attenr)
+    setInputFilter(chan, filt), filteredInput(chan)
+                filter an input channel as it is acquired (a Utility.StreamingFilter),
+                and the filtered data of the last play
+    play(wavel, waver, samplefreq, postduration, stop)
+                present the stereo stimulus and return the two input channels,
+                or None if stop() became True first
+    off()       turn the hardware off
+
+Backends:
+    NITDTBackend     - NI 6731 DAC for output, TDT PA5 attenuators, TDT RP2.1 for input
+    PyAudioBackend   - system sound card, full duplex (testing only)
+    SimulatedBackend - the NI/TDT path run against SimulatedDevices, with
+                       synthetic startle responses; runs headless on any OS
+"""
+# Paul B. Manis, Ph.D.
+# UNC Chapel Hill
+# Department of Otolaryngology/Head and Neck Surgery
+# Supported by NIH Grants DC000425-22 and DC004551-07 to PBM.
+#
+"""
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import abc
+import numpy as np
+from Acquisition import AcquisitionEngine
+import AudioEngine
+
+class HardwareError(Exception):
+    pass
+
+class HardwareNotFound(HardwareError):
+    """ the devices or their drivers are not installed here (another backend may be) """
+    pass
+
+
+class Backend(object):
+    __metaclass__ = abc.ABCMeta
+    name = None
+    out_sampleFreq = 44100.0
+    in_sampleFreq = 44100.0
+
+    def __init__(self):
+        self.debugFlag = False
+        self.inSession = False
+        self.inputFilters = {} # input channel -> StreamingFilter
+        self.filteredInputs = {}
+
+    def open(self):
+        pass
+
+    def startSession(self):
+        self.inSession = True
+
+    def endSession(self):
+        self.inSession = False
+        self.off()
+
+    def setAttens(self, attenl=120, attenr=120):
+        pass
+
+    def setInputFilter(self, chan, filt):
+        """ filter input chan as it is acquired, with filt (a Utility.StreamingFilter);
+            None removes the filter """
+        if filt is None:
+            self.inputFilters.pop(chan, None)
+        else:
+            self.inputFilters[chan] = filt
+
+    def filteredInput(self, chan):
+        """ the filtered data of input chan from the last play (None if it is not filtered) """
+        return self.filteredInputs.get(chan)
+
+    def filterInputs(self, data):
+        """ for backends that get the recording in one piece: filter it whole """
+        self.filteredInputs = {}
+        for (chan, filt) in self.inputFilters.items():
+            filt.reset()
+            self.filteredInputs[chan] = filt.filter(np.asarray(data[chan], dtype=float))
+
+    @abc.abstractmethod
+    def play(self, wavel, waver, samplefreq, postduration=0.35, stop=None):
+        """ present the stimulus; returns the two input channels, or None if stopped """
+
+    def off(self):
+        pass
+
+# clip data to max value (+/-) to avoid problems with daqs
+    def clip(self, data, maxval):
+        if self.debugFlag:
+            print "PySounds.clip: max(data) = %f, %f and maxval = %f" % (
+                max(data), min(data), maxval)
+        clip = 0
+        u = np.where(data >= maxval)
+        ul = list(np.transpose(u).flat)
+        if len(ul) > 0:
+            data[ul] = maxval
+            clip = 1 # set a flag in case we want to know
+            if self.debugFlag:
+                print "PySounds.clip: clipping %d positive points" % (len(ul))
+        minval = -maxval
+        v = np.where(data <= minval)
+        vl = list(np.transpose(v).flat)
+        if len(vl) > 0:
+            data[vl] = minval
+            clip = 1
+            if self.debugFlag:
+                print "PySounds.clip: clipping %d negative points" % (len(vl))
+        if self.debugFlag:
+            print "PySounds.clip: clipped max(data) = %f, %f and maxval = %f" % (
+                    max(data), min(data), maxval)
+        return (data, clip)
+
+
+class NITDTBackend(Backend):
+    """ NI DAC output with TDT System 3 attenuators (PA5) and input (RP2.1) """
+    name = 'nidaq'
+    COF = "C:\pyStartle\startle2.rco"
+    # the soft trigger of startle2.rco that starts the recording, and the one
+    # that resets the serial buffer indices (Index1/2) to 0
+    START_TRIGGER = 1
+    RESET_TRIGGER = 2
+    # the DAQmx constants used by makeTask and play
+    DAQMX_CONSTANTS = ('Val_Volts', 'Val_DigEdge', 'Val_Rising', 'Val_FiniteSamps')
+
+    def __init__(self):
+        Backend.__init__(self)
+        self.samp_cof_flag = 2 # 2 is for 24.4 kHz
+        self.samp_flist = [6103.5256125, 12210.703125, 24414.0625, 48828.125,
+            97656.25, 195312.5]
+        self.out_sampleFreq = 100000
+        self.in_sampleFreq = self.samp_flist[self.samp_cof_flag]
+
+    def open(self):
+        if os.name is not 'nt':
+            raise HardwareNotFound("NI/TDT hardware requires Windows (NT or XP)")
+        if self.debugFlag:
+            print "PySounds.init: OS is Windows (NT or XP)"
+        # get the drivers and the activeX control (win32com)
+        try:
+            # the module, not the package: init() sets the DAQmx constants on
+            # nidaq.nidaq, after the package copied its namespace at import
+            from nidaq import nidaq as nidaqmx
+            import win32com.client
+            import pywintypes
+            # driver binding is deferred until now; the driver itself (not the
+            # NIDAQ proxy) is used from here on, so devices and tasks hold it
+            nidaq_devs = nidaqmx.init()
+        except (ImportError, OSError), e:
+            raise HardwareNotFound("NI/TDT drivers not available: %s" % e)
+        if self.debugFlag:
+            print "PySounds.init: Attempt to Assert num devs > 0:",
+        try:
+            devices = nidaq_devs.listDevices()
+            if len(devices) == 0:
+                raise HardwareNotFound("No NI devices found")
+            self.dev0 = nidaq_devs.getDevice('Dev2')
+        except nidaqmx.NIDAQError, e:
+            raise HardwareError("NI-DAQmx error: %s" % (e,))
+        missing = [c for c in self.DAQMX_CONSTANTS if not hasattr(nidaqmx, c)]
+        if len(missing) > 0:
+            raise HardwareError("NI-DAQmx constants not defined: %s" % (', '.join(missing)))
+        self.nidaq = nidaqmx
+        if self.debugFlag:
+            print "PySounds.init: found nidq devices."
+            print "devices: %s" % nidaq_devs.listDevices()
+            print "getDevice:",
+            print "  ", self.dev0
+
+            print "\nAnalog Output Channels:",
+        # print "  AI: ", self.dev0.listAIChannels()
+            print " AO: ", self.dev0.listAOChannels() # check output only
+        # active x connection to attenuators
+        try:
+            self.connect(win32com.client.Dispatch("PA5.x"),
+                         win32com.client.Dispatch("RPco.x")) # connect to RP2.1
+        except pywintypes.com_error, e:
+            raise HardwareError("TDT ActiveX error: %s" % (e,))
+
+    def connect(self, PA5, RP21):
+        hwerr = 0
+        self.PA5 = PA5
+        a = self.PA5.ConnectPA5("USB", 1)
+        if a > 0 and self.debugFlag:
+            print "PySounds.init: Connected to PA5 Attenuator 1"
+        elif a <= 0:
+            print "PySounds.init: Failed to connect to PA5 Attenuator 1"
+            hwerr = 1
+        self.PA5.SetAtten(120.0)
+        a = self.PA5.ConnectPA5("USB", 2)
+        if a > 0 and self.debugFlag:
+            print "PySounds.init: Connected to PA5 Attenuator 2"
+        elif a <= 0:
+            print "PySounds.init: Failed to connect to PA5 Attenuator 2"
+            hwerr = 1
+        self.PA5.SetAtten(120.0)
+        self.RP21 = RP21
+        a = self.RP21.ConnectRP2("USB", 1)
+        if a > 0 and self.debugFlag:
+            print "PySounds.init: RP2.1 Connect is good: %d" % (a)
+        elif a <= 0:
+            print "PySounds.init: Failed to connect to RP2.1"
+            hwerr = 1
+        self.RP21.ClearCOF()
+        if self.samp_cof_flag > 5:
+            self.samp_cof_flag = 5
+        a = self.RP21.LoadCOFsf(self.COF, self.samp_cof_flag)
+        if a > 0:
+            print "PySounds.init: Connected to TDT RP2.1 and startle2.rco is loaded"
+        else:
+            print "PySounds.init: Error loading startle2.rco?, error = %d" % (a)
+            hwerr = 1
+        self.in_sampleFreq = self.samp_flist[self.samp_cof_flag]
+        self.acq = AcquisitionEngine(self.RP21)
+        if hwerr == 1:
+            raise HardwareError("PySounds.init: ?? Error connecting to hardware")
+
+    def setAttens(self, attenl=120, attenr=120):
+        self.PA5.ConnectPA5("USB", 1)
+        self.PA5.SetAtten(attenl)
+        self.PA5.ConnectPA5("USB", 2)
+        self.PA5.SetAtten(attenr)
+
+    def startSession(self):
+        Backend.startSession(self)
+        self.task = self.makeTask() # the output task is kept for the run
+
+    def setInputFilter(self, chan, filt):
+        # the RP2.1 data are filtered a poll at a time, as they are drained
+        Backend.setInputFilter(self, chan, filt)
+        self.acq.setFilter(chan, filt)
+
+    def filteredInput(self, chan):
+        if chan not in self.inputFilters:
+            return None
+        return self.acq.filteredData(chan)
+
+    def endSession(self):
+        Backend.endSession(self)
+        self.task = None # clears the task
+
+    def makeTask(self):
+        task = self.dev0.createTask()  # creat a task for the NI 6731 board.
+        task.CreateAOVoltageChan("/Dev2/ao0", "ao0", -10., 10.,
+                                 self.nidaq.Val_Volts, None)
+        task.CreateAOVoltageChan("/Dev2/ao1", "ao1", -10., 10.,
+                                 self.nidaq.Val_Volts, None) # use 2 channels
+        # DAQmxCfgDigEdgeStartTrig (taskHandle, "PFI0", DAQmx_Val_Rising);
+        task.SetStartTrigType(self.nidaq.Val_DigEdge)
+        task.CfgDigEdgeStartTrig('PFI0',  self.nidaq.Val_Rising)
+        return task
+
+    def play(self, wavel, waver, samplefreq, postduration=0.35, stop=None):
+        if not self.inSession or self.task is None:
+            self.task = self.makeTask()
+        wlen = 2*len(wavel)
+        # the length changes from trial to trial, so the timing is set every time
+        self.task.CfgSampClkTiming(None, samplefreq, self.nidaq.Val_Rising,
+                                   self.nidaq.Val_FiniteSamps, len(wavel))
+        daqwave = np.zeros(wlen)
+        (wavel, clipl) = self.clip(wavel, 10.0)
+        (waver, clipr) = self.clip(waver, 10.0)
+
+        daqwave[0:len(wavel)] = wavel
+        daqwave[len(wavel):] = waver # concatenate channels (using "groupbychannel" in writeanalogf64)
+        dur = wlen/float(samplefreq)
+        self.task.write(daqwave)
+        # now take in some acquisition...
+        if not self.resetBuffers():
+            return None
+
+        self.trueFreq = self.RP21.GetSFreq()
+        Ndata = int(np.ceil(0.5*(dur+postduration)*self.trueFreq))
+        self.RP21.SetTagVal('REC_Size', Ndata)  # old version using serbuf  -- with
+        # new version using SerialBuf, can't set data size - it is fixed.
+        # however, old version could not read the data size tag value, so
+        # could not determine when buffer was full/acquisition was done.
+        self.setAttens(10.0,10.0) # set equal, but not at minimum...
+
+        self.task.start() # start the NI AO task
+        a = self.RP21.Run() # start the RP2.1 processor...
+        a = self.RP21.SoftTrg(self.START_TRIGGER) # and trigger it. RP2.1 will in turn start the ni card
+        # the input is drained into the ring buffer while the output plays;
+        # both waits poll at a bounded rate instead of spinning
+        self.acq.start(Ndata)
+        if not self.acq.waitFor(self.task.isTaskDone, stop, drain=True):
+            self.RP21.Halt()
+            self.task.stop()
+            return None
+        self.task.stop() # done, so stop the output.
+        self.setAttens() # attenuators down (there is noise otherwise)
+        # collect the rest of the data...
+        data = self.acq.acquire(stop=stop)
+        if data is None:
+            self.RP21.Halt()
+            return None
+        # ch2 = ch2 - mean(ch2[1:int(Ndata/20)]) # baseline: first 5% of trace
+        self.off()
+        return data
+
+    def resetBuffers(self):
+        """ start the RP2.1 serial buffers and their indices (Index1/2) from 0 for
+            the trial, as AcquisitionEngine.drain assumes. Outside a run the
+            circuit is reloaded, as it always was. In a run the loaded circuit
+            is reset in place: the data buffers are zeroed and the reset trigger
+            returns the indices to 0. The circuit is reloaded only if that did
+            not work. """
+        if self.inSession:
+            self.RP21.Run() # triggers are only seen by a running circuit
+            for tag in self.acq.datatags:
+                self.RP21.ZeroTag(tag)
+            self.RP21.SoftTrg(self.RESET_TRIGGER)
+            if all([int(self.RP21.GetTagVal(tag)) == 0 for tag in self.acq.indextags]):
+                return True
+            print "PySounds.playSound: RP2.1 buffer indices not reset by trigger %d; reloading startle2.rco" % (
+                  self.RESET_TRIGGER)
+        a = self.RP21.ClearCOF()
+        if a <= 0:
+            print "PySounds.playSound: Unable to clear RP2.1"
+            return False
+        a = self.RP21.LoadCOFsf(self.COF, self.samp_cof_flag)
+        if a > 0 and self.debugFlag:
+            print "PySounds.playSound: Connected to TDT RP2.1 and startle2.rco is loaded"
+        elif a <= 0:
+            raise ValueError("PySounds.playSound: Error loading startle2.rco?, error = %d" % (a))
+        return True
+
+    def off(self):
+        if getattr(self, 'task', None) is not None:
+            self.task.stop()
+        self.setAttens()
+        self.RP21.Halt()
+
+
+class SimulatedBackend(NITDTBackend):
+    """ The NI/TDT path, run against simulated devices. The RP2.1 returns a
+        synthetic startle response to each stimulus (see SimulatedDevices.startleResponse).
+        timescale speeds up the simulated clock; None makes data available at once. """
+    name = 'simulated'
+
+    def __init__(self, timescale=1.0, seed=None):
+        NITDTBackend.__init__(self)
+        self.timescale = timescale
+        self.seed = seed
+
+    def open(self):
+        import SimulatedDevices
+        self.sim = SimulatedDevices
+        self.nidaq = SimulatedDevices
+        self.dev0 = SimulatedDevices.SimulatedDevice(self.timescale)
+        self.responder = SimulatedDevices.StartleResponder(seed=self.seed)
+        self.connect(SimulatedDevices.SimulatedPA5(),
+                     SimulatedDevices.SimulatedRP21(timescale=self.timescale))
+
+    def play(self, wavel, waver, samplefreq, postduration=0.35, stop=None):
+        # the response depends on the stimulus, so hand it to the simulated RP2.1 first
+        self.RP21.source = self.responder.source(wavel, waver, samplefreq)
+        return NITDTBackend.play(self, wavel, waver, samplefreq, postduration, stop)
+
+
+class PyAudioBackend(Backend):
+    """ system sound card through PyAudio, full duplex (see AudioEngine.py).
+        Used only for testing. """
+    name = 'pyaudio'
+    chunk = 1024 # frames per buffer
+
+    def open(self):
+        try:
+            import pyaudio
+        except ImportError, e:
+            raise HardwareNotFound("PyAudio is not available: %s" % e)
+        self.pyaudio = pyaudio
+        # loopback latency measured by AudioEngine.py, if it has been
+        self.latency = AudioEngine.readLatency(AudioEngine.LATENCY_FILE, self.out_sampleFreq)
+
+    def play(self, wavel, waver, samplefreq, postduration=0.35, stop=None):
+        if len(wavel) != len(waver):
+            print "PySounds.playSound: waves not matched in length: %d vs. %d (L,R)" % (len(wavel), len(waver))
+            return None
+        CHANNELS = 2
+        RATE = samplefreq
+        if self.debugFlag:
+            print "PySounds.playSound: samplefreq: %f" % (RATE)
+        self.openEngine(RATE)
+        # the stereo stimulus, followed by silence while the response is recorded,
+        # as one interleaved float32 array of (frames, channels): the layout the stream wants
+        n = len(wavel)
+        postdur = int(float(postduration*RATE))
+        wave = np.zeros((n+postdur, CHANNELS), dtype='float32')
+        wave[0:n, 0] = waver
+        wave[0:n, 1] = wavel  # order chosen so matches entymotic earphones on my macbookpro.
+        self.clip(wave[0:n, 0], 20.0)
+        self.clip(wave[0:n, 1], 20.0)
+        rwave = self.engine.play(wave, stop) # input is recorded in the same stream
+        if self.debugFlag and self.engine.status != 0:
+            print "PySounds.playSound: stream over/underflow (status %d)" % (self.engine.status)
+        if not self.inSession:
+            self.off()
+        if rwave is None:
+            return None
+        data = (rwave[:, 0], rwave[:, 1])
+        self.filterInputs(data)
+        return data
+
+    def startSession(self):
+        Backend.startSession(self)
+        self.openEngine(self.out_sampleFreq) # the stream is kept open for the run
+
+    def openEngine(self, samplefreq):
+        """ a duplex engine (and its stream) at samplefreq, reused if there is one """
+        if hasattr(self, 'engine'):
+            if self.engine.samplefreq == samplefreq:
+                return
+            self.off()
+        latency = None
+        if samplefreq == self.out_sampleFreq:
+            latency = self.latency
+        self.audio = self.pyaudio.PyAudio()
+        self.engine = AudioEngine.DuplexEngine(self.pyaudio, self.audio, samplefreq, 2,
+                                               self.chunk, latency)
+        self.engine.open()
+
+    def calibrate(self):
+        """ measure and save the loopback latency (outputs wired to the inputs) """
+        self.off()
+        self.audio = self.pyaudio.PyAudio()
+        self.engine = AudioEngine.DuplexEngine(self.pyaudio, self.audio, self.out_sampleFreq)
+        try:
+            self.latency = self.engine.calibrate()
+        finally:
+            self.off()
+        AudioEngine.saveLatency(self.latency, self.out_sampleFreq)
+        return self.latency
+
+    def off(self):
+        if hasattr(self, 'engine'):
+            self.engine.close()
+            self.audio.terminate()
+            del self.engine
+
+
+def findBackend(simulate=False, debug=False):
+    """ the first thing we must do is find out what hardware is available and
+        what system we are on: NI/TDT if it is installed, otherwise the system
+        sound card. NI/TDT hardware that is installed but fails to connect (an
+        attenuator or the RP2.1 off, the circuit not loaded) is an error: the
+        session must not go on through the sound card instead. """
+    if simulate:
+        candidates = [SimulatedBackend]
+    else:
+        candidates = [NITDTBackend, PyAudioBackend]
+    for c in candidates:
+        backend = c()
+        backend.debugFlag = debug
+        try:
+            backend.open()
+            return backend
+        except HardwareNotFound, e:
+            if debug:
+                print "PySounds.init: %s" % e
+    raise HardwareNotFound("No recognized hardware to use here")
@@ -9,7 +9,8 @@
 # Second channel of RP2.1 is collected as well. Use this for a microphone input
 # to monitor sound in the chamber.
 # If the system sound card is used, stimuli are generated and microphone input is
-# collected, but they are not simultaneous. This is used only for testing.
+# collected in the same (full duplex) stream, aligned using the loopback latency
+# measured by AudioEngine.py. This is used only for testing.
 #
 
 # 12/17/2008 Paul B. Manis, Ph.D.
@@ -39,112 +40,360 @@
     pmanis@med.unc.edu, with the subject line "PySounds Modifications". 
     
 """
+import time, zlib, re
 import scipy.signal
 #import matplotlib.pyplot as plt
 import scipy
-import pyaudio
-import struct, ctypes
 import numpy as np
+from Utility import filterCache
+import Hardware
 
 REF_ES_dB = 86.0 # calibration info -  Assumes 10 dB padding with attenuator.
 REF_ES_volt = 2.0 # output in volts to get refdb
 REF_MAG_dB = 100.0 # right speaker is mag... different scaling.
 
+#
+# Rise-fall envelopes. The sin^2 ramps depend only on the rise-fall time and
+# the sample rate, so they are computed once and kept. Envelopes are applied
+# in place, to the ramp regions of a slice of the waveform, so no full length
+# envelope is ever built (a multi-second conditioning stimulus at 100 kHz
+# would otherwise need several MB of temporaries per trial).
+#
+class Envelope:
+    def __init__(self):
+        self.ramps = {} # (nf) -> (rise, fall, 1-rise, 1-fall)
+        self.hits = 0
+        self.misses = 0
+
+    def npoints(self, rf, samplefreq):
+        return int(np.floor((rf/1000.0)*samplefreq)) # number of points in the ramp
+
+    def ramp(self, rf, samplefreq):
+        """ (rise, fall, 1-rise, 1-fall) ramps for rf msec at samplefreq (read only) """
+        nf = self.npoints(rf, samplefreq)
+        try:
+            r = self.ramps[nf]
+            self.hits += 1
+        except KeyError:
+            # sin^2 from 0 to 90 deg; the fall is the rise reversed, starting from
+            # the plateau (as in the original full-length filter)
+            rise = np.sin(0.5*np.pi*np.arange(nf)/max(nf, 1))**2
+            fall = np.concatenate((np.ones(min(nf, 1)), rise[:0:-1]))
+            r = (rise, fall, 1.0 - rise, 1.0 - fall)
+            for a in r:
+                a.flags.writeable = False
+            self.ramps[nf] = r
+            self.misses += 1
+        return r
+
+    def shape(self, wave, start, npts, rf, samplefreq):
+        """ turn wave[start:start+npts] on and off with the ramps, in place """
+        (rise, fall) = self.ramp(rf, samplefreq)[0:2]
+        self._apply(wave, start, npts, rise, fall)
+        return wave
+
+    def gap(self, wave, start, npts, rf, samplefreq):
+        """ turn wave[start:start+npts] off (a gap with shaped edges), in place """
+        (offramp, onramp) = self.ramp(rf, samplefreq)[2:4]
+        self._apply(wave, start, npts, offramp, onramp)
+        wave[start+len(offramp):start+npts-len(onramp)] = 0.0
+        return wave
+
+    def _apply(self, wave, start, npts, first, last):
+        end = min(start + npts, len(wave))
+        start = max(start, 0)
+        nf = min(len(first), max(end - start, 0))
+        wave[start:start+nf] *= first[0:nf]
+        nl = min(len(last), max(end - start, 0))
+        wave[end-nl:end] *= last[len(last)-nl:]
+
+    def stats(self):
+        return(self.hits, self.misses)
+
+envelopes = Envelope()
+
+#
+# Tone synthesis. A sum of sines is made a block at a time from a cached
+# phasor table, exp(i*outer(n, w)) for the points n of one block: each block
+# of the signal is that table times the tones' phasors at the block start, so
+# all the frequencies are done in one matrix-vector product, with no sin per
+# point, and no phase error builds up over a long tone (the start phasors are
+# exact). Zero frequencies (placeholders, as in (PP_Freq, 0)) are skipped.
+#
+class ToneBank:
+    def __init__(self, block=4096, maxtables=16):
+        self.block = block
+        self.maxtables = maxtables
+        self.tables = {} # (w) -> phasor table, (block, len(w))
+        self.hits = 0
+        self.misses = 0
+
+    def table(self, w):
+        key = tuple(w)
+        try:
+            t = self.tables[key]
+            self.hits += 1
+        except KeyError:
+            if len(self.tables) >= self.maxtables:
+                self.tables.clear()
+            t = np.exp(1j*np.outer(np.arange(self.block), w))
+            t.flags.writeable = False
+            self.tables[key] = t
+            self.misses += 1
+        return t
+
+    def render(self, freq, npts, samplefreq, amp=1, phase=0, out=None):
+        """ sum of amp*sin(2*pi*f*t + phase) over freq (Hz); amp and phase may
+            be per tone. Written into out[0:npts] if given, else a new array. """
+        freq = np.atleast_1d(np.asarray(freq, dtype=float))
+        amp = np.broadcast_to(np.asarray(amp, dtype=float), freq.shape)
+        phase = np.broadcast_to(np.asarray(phase, dtype=float), freq.shape)
+        if out is None:
+            out = np.zeros(npts)
+        else:
+            out = out[0:npts]
+        keep = freq != 0
+        if not np.any(keep):
+            out[:] = 0.0
+            return out
+        w = 2*np.pi*freq[keep]/samplefreq
+        amp = amp[keep]
+        phase = phase[keep]
+        table = self.table(w)
+        for j in range(0, npts, self.block):
+            n = min(self.block, npts - j)
+            out[j:j+n] = np.dot(table[0:n], amp*np.exp(1j*(w*j + phase))).imag
+        return out
+
+    def stats(self):
+        return(self.hits, self.misses)
+
+tones = ToneBank()
+
+#
+# Parse a multiple frequency specification (as in the PP_MultiFreq field), in
+# kHz: a list ("2, 4, 8 16"), or linspace(start, stop, num) or
+# geomspace(start, stop, num). Returns the frequencies in Hz. The text is
+# parsed, not evaluated; anything else raises ValueError.
+#
+def parseFrequencies(spec):
+    s = spec.strip()
+    m = re.match(r'^(linspace|geomspace)\s*\((.*)\)$', s)
+    try:
+        if m is not None:
+            args = [float(a) for a in m.group(2).split(',')]
+            if len(args) != 3 or args[2] < 1 or args[2] != int(args[2]):
+                raise ValueError
+            if m.group(1) == 'geomspace':
+                if args[0] <= 0 or args[1] <= 0:
+                    raise ValueError
+                f = np.exp(np.linspace(np.log(args[0]), np.log(args[1]), int(args[2])))
+            else:
+                f = np.linspace(args[0], args[1], int(args[2]))
+        else:
+            f = np.array([float(a) for a in re.split(r'[,\s]+', s.strip('[]() ')) if len(a) > 0])
+    except ValueError:
+        raise ValueError("Cannot parse frequency list: '%s'" % (spec))
+    if len(f) == 0 or np.any(f <= 0):
+        raise ValueError("Cannot parse frequency list: '%s'" % (spec))
+    return 1000.0*f
+
+#
+# Band-limited noise made in the frequency domain: gaussian spectral components
+# in the passband [f0, f1], none in the stop bands (a list of [f0, f1]), and a
+# real FFT (of a power of 2 length) back to time. With rolloff = 0 the band edges
+# are exact (brick wall); otherwise the spectrum falls off as cos^2 over rolloff
+# Hz outside the passband (and inside the stop bands). The variance is that of
+# white noise (sd 1) passed through the same band, as for the IIR filtered noise.
+#
+def bandGain(f, passband, stopbands=[], rolloff=0.0):
+    def edge(d): # 1 at d <= 0, falling to 0 at d >= rolloff
+        if rolloff <= 0:
+            return (d <= 0).astype(float)
+        return np.cos(0.5*np.pi*np.clip(d/rolloff, 0.0, 1.0))**2
+    gain = edge(passband[0] - f)*edge(f - passband[1])
+    for sb in stopbands:
+        gain *= 1.0 - edge(f - sb[0])*edge(sb[1] - f)
+    return gain
+
+def fftNoise(npts, samplefreq, passband, stopbands=[], rng=np.random, rolloff=0.0):
+    nfft = 1 << int(np.ceil(np.log2(max(npts, 2))))
+    f = np.fft.rfftfreq(nfft, 1.0/samplefreq)
+    gain = bandGain(f, passband, stopbands, rolloff)
+    k = np.nonzero(gain)[0] # only the components in the band need random numbers
+    spec = np.zeros(len(f), dtype=complex)
+    spec[k] = (rng.normal(0, 1, len(k)) + 1j*rng.normal(0, 1, len(k)))*np.sqrt(nfft/2.0)*gain[k]
+    spec[0] = 0.0
+    spec[-1] = spec[-1].real # the nyquist component of a real signal
+    return np.fft.irfft(spec, nfft)[0:npts]
+
+#
+# Noise for the stimuli. All draws come from a seeded RandomState, so a
+# session's stimuli can be made again from its seed: setTrial(trial) starts
+# the stream for that trial from (seed, trial), whatever order the trials are
+# made in. Band-limited noise is cut at a random place from a pool that is
+# filtered once per band (and seed), so the cost of making noise does not grow
+# with the number of trials.
+#
+class NoiseSource:
+    def __init__(self, seed=None, poolduration=10.0):
+        self.poolduration = poolduration # seconds of noise in each pool
+        self.reseed(seed)
+
+    def reseed(self, seed=None):
+        """ start a new session: a new seed (random if None) and empty pools """
+        if seed is None:
+            seed = np.random.RandomState().randint(0, 2**31-1)
+        self.seed = int(seed)
+        self.pools = {}
+        self.setTrial(None)
+
+    def setTrial(self, trial=None):
+        if trial is None:
+            self.rng = np.random.RandomState(self.seed)
+        else:
+            self.rng = np.random.RandomState([self.seed, int(trial)])
+
+    def normal(self, npts):
+        """ white gaussian noise, sd 1 """
+        return self.rng.normal(0, 1, npts)
+
+    def pool(self, key, npts, samplefreq, make):
+        """ the pool for key, at least npts long. make(rng, n) makes n points of
+            the noise from the random numbers in rng. """
+        p = self.pools.get(key)
+        if p is None or len(p) < npts:
+            n = max(int(self.poolduration*samplefreq), 2*npts)
+            rng = np.random.RandomState([self.seed, zlib.crc32(repr(key)) & 0x7fffffff])
+            p = make(rng, n)
+            self.pools[key] = p
+        return p
+
+    def band(self, key, npts, samplefreq, make):
+        """ npts of band-limited noise: a random segment of the pool for key """
+        p = self.pool(key, npts, samplefreq, make)
+        j = self.rng.randint(0, len(p) - npts + 1)
+        return p[j:j+npts]
+
+#
+# The Compositor assembles a stimulus from its components (conditioning sound,
+# gap, prepulse, startle) in one preallocated (nchannels, maxpoints) float32
+# buffer: each component is added at its offset, and gaps are cut in place,
+# so a trial allocates nothing beyond the components themselves. The buffer is
+# reused for every trial; the views returned by channels() are only valid
+# until the next begin(). Times are in msec, as for StimulusMaker.
+#
+class Compositor:
+    def __init__(self, maxpoints, samplefreq, nchannels=2):
+        self.buf = np.zeros((nchannels, maxpoints), dtype='float32')
+        self.samplefreq = samplefreq
+        self.length = 0
+        self.peak = self.buf.nbytes # buffer plus the largest component added
+        self.clipped = 0 # points of components that did not fit in the buffer
+
+    def offset(self, delay):
+        return max(int(np.floor((delay/1000.0)*self.samplefreq)), 0)
+
+    def begin(self, duration=0):
+        """ start a new stimulus, at least duration msec long """
+        self.buf[:, 0:self.length] = 0.0
+        self.length = min(self.offset(duration), self.buf.shape[1])
+
+    def add(self, channel, wave, delay=0, scale=1.0):
+        """ add scale*wave to channel, starting at delay """
+        j0 = self.offset(delay)
+        n = min(len(wave), self.buf.shape[1] - j0)
+        if n < len(wave):
+            self.clipped += len(wave) - max(n, 0)
+        if n <= 0:
+            return
+        if scale != 1.0:
+            self.buf[channel, j0:j0+n] += scale*wave[0:n]
+        else:
+            self.buf[channel, j0:j0+n] += wave[0:n]
+        self.length = max(self.length, j0+n)
+        self.peak = max(self.peak, self.buf.nbytes + np.asarray(wave).nbytes)
+
+    def gap(self, channel, delay, duration, rf=2.5):
+        """ cut a shaped gap into what has been added to channel so far """
+        j0 = self.offset(delay)
+        envelopes.gap(self.buf[channel, 0:self.length], j0, self.offset(delay+duration)-j0,
+                      rf, self.samplefreq)
+
+    def channels(self):
+        return [self.buf[i, 0:self.length] for i in range(0, self.buf.shape[0])]
+
+    def nbytes(self):
+        return self.buf.nbytes
+
+    def peakBytes(self):
+        return self.peak
+
 class PySounds:
     
-    def __init__(self):
+    def __init__(self, simulate=False, lazy=True):
     ################################################################################
     # the first thing we must do is find out what hardware is available and what
-    # system we are on.
+    # system we are on. The devices themselves are handled by a backend from
+    # Hardware.py: NI/TDT, the system sound card, or (simulate=True) a simulator.
+    # With lazy=True (the default), the hardware is not probed until it is first
+    # needed, so programs that only analyze data never pay for it.
     ################################################################################
         self.debugFlag = False
-        if self.debugFlag:
-            print "PySounds: Checking Hardware and OS"
-        try:
-            import os
-            if os.name is not 'nt':
-                assert 0 # force use of pyaudio if not on windows xp/nt.
-            if self.debugFlag:
-                print "PySounds.init: OS is Windows (NT or XP)"
-            # get the drivers and the activeX control (win32com)
-            from nidaq import NIDAQ as nidaq_devs
-#            import nidaq
-            import win32com.client
-            
-            if self.debugFlag:
-                print "PySounds.init: Attempt to Assert num devs > 0:",
-            assert(len(nidaq_devs.listDevices()) > 0)
-            self.dev0 = nidaq_devs.getDevice('Dev2')
-            hwerr = 0
-            if self.debugFlag:
-                print "PySounds.init: found nidq devices."
-                print "devices: %s" % nidaq_devs.listDevices()
-                print "getDevice:",
-                print "  ", self.dev0
-            
-                print "\nAnalog Output Channels:",
-            # print "  AI: ", self.dev0.listAIChannels()
-                print " AO: ", self.dev0.listAOChannels() # check output only
-            
-            # active x connection to attenuators
-            # note - variables set at this scope level are global to source file
-            self.PA5 = win32com.client.Dispatch("PA5.x")
-            a = self.PA5.ConnectPA5("USB", 1)
-            if a > 0 and self.debugFlag:
-                print "PySounds.init: Connected to PA5 Attenuator 1"
-            else:
-                print "PySounds.init: Failed to connect to PA5 Attenuator 1"
-                hwerr = 1
-            self.PA5.SetAtten(120.0)
-            a = self.PA5.ConnectPA5("USB", 2)
-            if a > 0 and self.debugFlag:
-                print "PySounds.init: Connected to PA5 Attenuator 2"
-            else:
-                print "PySounds.init: Failed to connect to PA5 Attenuator 2"
-                hwerr = 1
-                
-            self.PA5.SetAtten(120.0)
-            self.RP21 = win32com.client.Dispatch("RPco.x") # connect to RP2.1
-            a = self.RP21.ConnectRP2("USB", 1)
-            if a > 0 and self.debugFlag:
-                print "PySounds.init: RP2.1 Connect is good: %d" % (a)
-            else:
-                print "PySounds.init: Failed to connect to PA5 Attenuator 1"
-                hwerr = 1
-            self.RP21.ClearCOF()
-            self.samp_cof_flag = 2 # 2 is for 24.4 kHz
-            self.samp_flist = [6103.5256125, 12210.703125, 24414.0625, 48828.125, 
-            97656.25, 195312.5]
-            if self.samp_cof_flag > 5:
-                self.samp_cof_flag = 5
-            a = self.RP21.LoadCOFsf("C:\pyStartle\startle2.rco", self.samp_cof_flag)
-            if a > 0:
-                print "PySounds.init: Connected to TDT RP2.1 and startle2.rco is loaded"
-            else:
-                print "PySounds.init: Error loading startle2.rco?, error = %d" % (a)
-                hwerr = 1
-            self.hardware = 'nidaq'
-            self.out_sampleFreq = 100000
-            self.in_sampleFreq = self.samp_flist[self.samp_cof_flag]
-            if hwerr == 1:
-                print "PySounds.init: ?? Error connecting to hardware"
-                exit()                
-        except:
+        self.PPGo = True # cleared to stop an acquisition in progress
+        self.noise = NoiseSource() # reseed at the start of each session for new stimuli
+        self.simulate = simulate
+        self.backend = None
+        self.hardware = None
+        self.out_sampleFreq = 44100.0
+        self.in_sampleFreq = 44100.0
+        self.openTime = 0.0 # seconds taken to find and open the hardware
+        if not lazy:
+            self.openHardware()
+
+    def openHardware(self):
+        if self.backend is None:
             if self.debugFlag:
-                print "PySounds.init: OS or hardware only supports standard sound card"
-            self.hardware = 'pyaudio'
-            self.out_sampleFreq = 44100.0
-            self.in_sampleFreq = 44100.0
+                print "PySounds: Checking Hardware and OS"
+            t0 = time.time()
+            self.setBackend(Hardware.findBackend(simulate=self.simulate, debug=self.debugFlag))
+            self.openTime = time.time() - t0
+            print "PySounds: using %s hardware (%.0f ms to open)" % (self.hardware, 1000.0*self.openTime)
+        return self.backend
+
+# a session keeps the devices open and configured from the start of a run to its end
+    def startSession(self):
+        self.openHardware()
+        self.backend.startSession()
+
+    def endSession(self):
+        if self.backend is not None:
+            self.backend.endSession()
+
+    def isOpen(self):
+        return self.backend is not None
+
+    def setBackend(self, backend):
+        self.backend = backend
+        self.backend.debugFlag = self.debugFlag
+        self.hardware = backend.name
+        self.out_sampleFreq = backend.out_sampleFreq
+        self.in_sampleFreq = backend.in_sampleFreq
 
     def getHardware(self):
+        self.openHardware()
         return(self.hardware, self.out_sampleFreq, self.in_sampleFreq)
 
 # internal debug flag to control printing of intermediate messages        
     def debugOn(self):
         self.debugFlag = True
+        if self.backend is not None:
+            self.backend.debugFlag = True
     
     def debugOff(self):
         self.debugFlag = False
+        if self.backend is not None:
+            self.backend.debugFlag = False
     
 ################################################################################
 # STIMULUS GENERATION ROUTINES
@@ -155,65 +404,85 @@ class PySounds:
     def StimulusMaker(self, mode='tone', amp=1, freq=(1000, 3000, 4000), delay=0, duration=2000,
                   rf=2.5, phase0=0, samplefreq=44100, ipi=20, nPresent=1,
                   alternate=1, level=70,
-                  playSignal=False, plotSignal=False, channel=0):
+                  playSignal=False, plotSignal=False, channel=0, method='iir'):
 # generate a tsound (tone, bb noise, bpnoise)  pip with amplitude (V), frequency (Hz) (or frequencies, using a tuple)
 # delay (msec), duration (msec).
 # if no rf (risefall) time is given (units, msec), cosine^2 shaping with 5 msec ramp duration is applied.
 # if no phase is given, phase starts on 0, with positive slope.
-# level is in dB SPL as given by the reference calibration data above...
+# level is in dB SPL as given by the reference calibration data above (None: not scaled)...
+# method selects how bpnoise is made: 'iir' (elliptic filter) or 'fft' (exact band,
+# made in the frequency domain; faster for long stimuli).
 #
         clock = 1000.0/samplefreq # calculate the sample clock rate, and convert to points per msec (khz)
 #        uclock = 1000.*clock # microsecond clock
 #        phi = 2*np.pi*phase0/360.0 # convert phase from degrees to radians...
-        Fs = 1000./clock
         # phi = 0. # actually, always 0 phase for start
         w = []
-        fil = self.rfShape(0, duration, samplefreq, rf) # make the shape filter with 0 delay
+        siglen = max(int(np.floor((duration/1000.0)*samplefreq)), 0) # points in the signal
         jd = int(np.floor(delay/clock)) # beginning of signal buildup (delay time)
         if jd < 0:
             jd = 0
-        jpts = np.arange(0,len(fil))
-        signal = np.zeros(len(jpts))
-        siglen = len(signal)
+        signal = np.zeros(siglen)
  
         if mode =='tone':
-            for i in range(0, len(freq)):
-                signal = signal + fil*amp*np.sin(2*np.pi*freq[i]*jpts/Fs)
-                if self.debugFlag:
-                    print "Generated Tone at %7.1fHz" % (freq[i])
+            tones.render(freq, siglen, samplefreq, amp, out=signal)
+            if self.debugFlag:
+                print "Generated Tone at " + ", ".join(["%7.1fHz" % f for f in freq if f != 0])
+            envelopes.shape(signal, 0, siglen, rf, samplefreq)
                 
         if mode == 'bbnoise':
-            signal = signal + fil*amp*np.normal(0,1,siglen)
+            signal = amp*self.noise.normal(siglen)
+            envelopes.shape(signal, 0, siglen, rf, samplefreq)
             if self.debugFlag:
                 print "BroadBand Noise " 
             
         if mode == 'bpnoise':
-            tsignal = fil*amp*np.random.normal(0,1,siglen)
             # use freq[0] and freq[1] to set bandpass on the noise
             if self.debugFlag:
                 print "freqs: HP: %6.1f    LP: %6.1f" % (freq[0], freq[1])
-            sf2 = samplefreq*2.0 # nyquist limit
-            if freq[0] > sf2 or freq[1] > sf2:
+            sf2 = samplefreq/2.0 # nyquist limit
+            if freq[0] >= sf2 or freq[0] >= freq[1]:
                 print 'freqs: ', freq
                 print 'nyquist limit: ', sf2
                 print 'sample frequ: ', samplefreq
-                print 'coefficients not bounded [0, 1] for w... '
+                print 'bandpass is empty below the nyquist limit... '
                 return np.array(signal)
-            wp = [float(freq[0])/sf2, float(freq[1])/sf2]
-            ws = [0.75*float(freq[0])/sf2, 1.25*float(freq[1])/sf2]
-            (filter_b,filter_a) = scipy.signal.iirdesign(wp, ws,
-                    gpass=2.0,
-                    gstop=60.0,
-                    ftype="ellip")
+            if method == 'fft':
+                make = lambda rng, n: fftNoise(n, samplefreq, (freq[0], freq[1]), rng=rng)
+            else:
+                if 1.25*freq[1] < sf2:
+                    wp = [float(freq[0])/sf2, float(freq[1])/sf2]
+                    ws = [0.75*float(freq[0])/sf2, 1.25*float(freq[1])/sf2]
+                else: # the band runs up to nyquist: high pass
+                    wp = float(freq[0])/sf2
+                    ws = 0.75*float(freq[0])/sf2
+                sos = filterCache.design(wp, ws, gpass=2.0, gstop=60.0, ftype="ellip")
+                if self.debugFlag:
+                    print "Filter cache hits: %d  misses: %d" % filterCache.stats()
+                lead = int(0.1*samplefreq) # discard the filter's start-up transient
+                make = lambda rng, n: scipy.signal.sosfilt(sos, rng.normal(0, 1, n+lead))[lead:]
             if self.debugFlag:
-                print "BandPass Noise %7.1f-%7.1f" % (freq[0], freq[1])
-            signal=scipy.signal.lfilter(filter_b, filter_a, tsignal)
+                print "BandPass Noise %7.1f-%7.1f (%s)" % (freq[0], freq[1], method)
+            # a segment of noise from the pool for this band, then shaped
+            signal = amp*self.noise.band(('bpnoise', method, freq[0], freq[1], samplefreq), siglen,
+                                         samplefreq, make)
+            envelopes.shape(signal, 0, siglen, rf, samplefreq)
         
         if mode == 'notchnoise':
-            return np.array(signal)
-            
+            # bandpass noise from freq[0] to freq[1], with a notch from freq[2] to freq[3]
+            key = ('notchnoise', freq[0], freq[1], freq[2], freq[3], samplefreq)
+            signal = amp*self.noise.band(key, siglen, samplefreq,
+                          lambda rng, n: fftNoise(n, samplefreq, (freq[0], freq[1]),
+                                                  [(freq[2], freq[3])], rng=rng))
+            envelopes.shape(signal, 0, siglen, rf, samplefreq)
+            if self.debugFlag:
+                print "Notched Noise %7.1f-%7.1f, notch %7.1f-%7.1f" % tuple(freq[0:4])
+
         if mode == 'multitones':
-            return np.array(signal)
+            signal = self.toneComplex(freq, siglen, samplefreq, amp)
+            envelopes.shape(signal, 0, siglen, rf, samplefreq)
+            if self.debugFlag:
+                print "Generated %d tones, %7.1f to %7.1f Hz" % (len(freq), min(freq), max(freq))
 
         if mode == 'silence':
             return np.array(signal)
@@ -226,9 +495,10 @@ class PySounds:
         id = int(np.floor(ipi/clock))
         for i in range(0, nPresent): # for each pulse in the waveform
             j0 = jd + i*id # compute start time  
-            w[range(j0,j0+siglen)] = sign[i]*signal
+            w[j0:j0+siglen] = sign[i]*signal
         
-        w = w*self.dbconvert(spl=level, chan=channel) # aftera all the shaping ane scaling, we convert to generate a signal of w dB
+        if level is not None: # None leaves the scaling to the caller
+            w *= self.dbconvert(spl=level, chan=channel) # aftera all the shaping ane scaling, we convert to generate a signal of w dB
         if playSignal == True:
             self.playSound(w, w, samplefreq)
         
@@ -236,6 +506,17 @@ class PySounds:
 #            self.plotSignal(w, w, clock)
         return np.array(w)
 
+#
+# A sum of equal amplitude tones, made by the tone bank. The total rms is that
+# of one tone of amplitude amp, and Schroeder phases keep the peak of the sum
+# down.
+#
+    def toneComplex(self, freq, npts, samplefreq, amp=1):
+        freq = np.asarray(freq, dtype=float)
+        k = np.arange(len(freq))
+        phi = np.pi*k*(k-1)/float(len(freq))
+        return tones.render(freq, npts, samplefreq, amp/np.sqrt(len(freq)), phi)
+
 #
 # Rise-fall shaping of a waveform. This routine generates an envelope with
 # 1 as the signal max, and 0 as the baseline (off), with cosine^2 shaping of
@@ -243,40 +524,29 @@ class PySounds:
 # rise and fall, so the duration of the signal at full amplitude is dur - 2*rf.
 # Note that since samplefreq is in Hz, delya, rf and duratio are converted to
 # seconds from the msec in the call.
+# The ramps come from the envelope cache above; to shape a waveform, use
+# envelopes.shape on it directly rather than multiplying by this envelope.
     def rfShape(self, delay=0, duration=100, samplefreq=44100, rf=2.5):
         jd = int(np.floor((delay/1000.0)*samplefreq)) # beginning of signal buildup (delay time)
         if jd < 0:
             jd = 0
         je = int(np.floor(((delay+duration)/1000.0)*samplefreq)) # end of signal decay (duration + delay)
-        #
-        # build sin^2 filter from 0 to 90deg for shaping the waveform
-        #
-        nf = int(np.floor((rf/1000.0)*samplefreq)) # number of points in the filter
-        fo = 1.0/(4.0*(rf/1000.0)) # filter "frequency" in Hz - the 4 is because we use only 90deg for the rf component
-        
-        pts = np.arange(jd,jd+nf)
         fil = np.zeros(je)
-        fil[range(jd,jd+nf)] = np.sin(2*np.pi*fo*pts*samplefreq)**2 # filter
-        fil[range(jd+nf,je-nf)] = 1        
-        pts = range(je-nf,je)
-        kpts = range(jd+nf,jd,-1)
-        fil[pts] = fil[kpts]
-        return(fil)
+        fil[jd:je] = 1.0
+        return(envelopes.shape(fil, jd, je-jd, rf, samplefreq))
 
 #
 # insertGap takes a waveform and inserts a shaped gap into it.
 # currently, gap is all the way off, i.e., 0 intensity.
 # a future change is to include relative gap level (-dB from current waveform)
+# The gap is made in place (a float array is modified, and returned).
 #
     def insertGap(self, wave, delay=20, duration=20, rf=2.5, samplefreq=44100):
-        fil = self.rfShape(delay, duration, samplefreq, rf) # make the shape filter with 0 delay
-        lenf = len(fil)
-        lenw = len(wave)
-        if lenw > lenf:
-            fil = np.append(fil, np.zeros(lenw-lenf))
-        if lenf > lenw:
-            fil = np.append(fil, np.zeros(lenf-lenw))
-        return(wave*(1.0-fil))
+        if not (isinstance(wave, np.ndarray) and wave.dtype.kind == 'f'):
+            wave = np.array(wave, dtype=float)
+        jd = max(int(np.floor((delay/1000.0)*samplefreq)), 0) # start of the gap
+        je = int(np.floor(((delay+duration)/1000.0)*samplefreq)) # end of the gap
+        return(envelopes.gap(wave, jd, je-jd, rf, samplefreq))
           
 #
 # compute voltage from reference dB level
@@ -300,11 +570,8 @@ class PySounds:
 # If no args are given, set to max attenuation
 
     def setAttens(self, attenl=120, attenr=120):
-        if self.hardware == 'nidaq':
-            self.PA5.ConnectPA5("USB", 1)
-            self.PA5.SetAtten(attenl)
-            self.PA5.ConnectPA5("USB", 2)
-            self.PA5.SetAtten(attenr)
+        if self.backend is not None:
+            self.backend.setAttens(attenl, attenr)
 
 #
 # playSound sends the sound out to an audio device. In the absence of NI card
@@ -312,170 +579,26 @@ class PySounds:
 # The waveform is played in stereo.
 # Postduration is given in seconds... 
     def playSound(self, wavel, waver, samplefreq, postduration=0.35):
-        if self.hardware in ['pyaudio']:
-            self.audio = pyaudio.PyAudio()
-            chunk = 1024
-            FORMAT = pyaudio.paFloat32
-            CHANNELS = 2
-            RATE = samplefreq
-            if self.debugFlag:
-                print "PySounds.playSound: samplefreq: %f" % (RATE)
-            self.stream = self.audio.open(format=FORMAT,
-                            channels=CHANNELS,
-                            rate=int(RATE),
-                            output=True,
-                            input=True,
-                            frames_per_buffer=chunk)
-            # play stream
-            # print self.stream
-            wave = np.zeros(2*len(wavel))
-            if len(wavel) != len(waver):
-                print "PySounds.playSound: waves not matched in length: %d vs. %d (L,R)" % (len(wavel), len(waver))
-                return
-            (waver, clipr) = self.clip(waver, 20.0)
-            (wavel, clipl) = self.clip(wavel, 20.0)
-            wave[0::2] = waver 
-            wave[1::2] = wavel  # order chosen so matches entymotic earphones on my macbookpro.
-            postdur =  int(float(postduration*self.in_sampleFreq))
-            rwave = self.read_array(len(wavel)+postdur, CHANNELS)
-            self.write_array(wave)
-            self.HwOff()
-            # self.stream.stop_stream()
-#             self.stream.close()
-#             self.audio.terminate()
-            self.ch1 = rwave[0::2]
-            self.ch2 = rwave[1::2]
-            
-        elif self.hardware in ['nidaq']:
-            self.task = self.dev0.createTask()  # creat a task for the NI 6731 board.
-            self.task.CreateAOVoltageChan("/Dev2/ao0", "ao0", -10., 10.,
-                                          self.nidaq.Val_Volts, None)
-            self.task.CreateAOVoltageChan("/Dev2/ao1", "ao1", -10., 10.,
-                                          self.nidaq.Val_Volts, None) # use 2 channels
-            wlen = 2*len(wavel)
-            self.task.CfgSampClkTiming(None, samplefreq, self.nidaq.Val_Rising,
-                                       self.nidaq.Val_FiniteSamps, len(wavel))
-            # DAQmxCfgDigEdgeStartTrig (taskHandle, "PFI0", DAQmx_Val_Rising);
-            self.task.SetStartTrigType(self.nidaq.Val_DigEdge)
-            self.task.CfgDigEdgeStartTrig('PFI0',  self.nidaq.Val_Rising)
-            daqwave = np.zeros(wlen)
-            (wavel, clipl) = self.clip(wavel, 10.0)
-            (waver, clipr) = self.clip(waver, 10.0)
-            
-            daqwave[0:len(wavel)] = wavel
-            daqwave[len(wavel):] = waver # concatenate channels (using "groupbychannel" in writeanalogf64)
-            dur = wlen/float(samplefreq)
-            self.task.write(daqwave)
-            # now take in some acquisition...
-            a = self.RP21.ClearCOF()
-            if a <= 0:
-                print "PySounds.playSound: Unable to clear RP2.1"
-                return
-            a = self.RP21.LoadCOFsf("C:\pyStartle\startle2.rco", self.samp_cof_flag)
-            if a > 0 and self.debugFlag:
-                print "PySounds.playSound: Connected to TDT RP2.1 and startle2.rco is loaded"
-            else:
-                raise ValueError("PySounds.playSound: Error loading startle2.rco?, error = %d" % (a))
-
-            self.trueFreq = self.RP21.GetSFreq()
-            Ndata = np.ceil(0.5*(dur+postduration)*self.trueFreq)
-            self.RP21.SetTagVal('REC_Size', Ndata)  # old version using serbuf  -- with
-            # new version using SerialBuf, can't set data size - it is fixed.
-            # however, old version could not read the data size tag value, so
-            # could not determine when buffer was full/acquisition was done.
-            self.setAttens(10.0,10.0) # set equal, but not at minimum...
-
-            self.task.start() # start the NI AO task
-            a = self.RP21.Run() # start the RP2.1 processor...
-            a = self.RP21.SoftTrg(1) # and trigger it. RP2.1 will in turn start the ni card
-            while not self.task.isTaskDone():  # wait for AO to finish?
-                if not self.PPGo: # while waiting, check for stop.
-                    self.RP21.Halt()
-                    self.task.stop()
-                    return
-            self.task.stop() # done, so stop the output.
-            self.setAttens() # attenuators down (there is noise otherwise)
-            # read the data...
-            curindex1 = self.RP21.GetTagVal('Index1')
-            curindex2 = self.RP21.GetTagVal('Index2')
-            while(curindex1 < Ndata or curindex2 < Ndata): # wait for input data to be sampled
-                if not self.PPGo: # while waiting, check for stop.
-                    self.RP21.Halt()
-                    return
-                curindex1 = self.RP21.GetTagVal('Index1')
-                curindex2 = self.RP21.GetTagVal('Index2')
-            self.task.stop()   
-            self.ch2 = self.RP21.ReadTagV('Data_out2', 0, Ndata)
-            # ch2 = ch2 - mean(ch2[1:int(Ndata/20)]) # baseline: first 5% of trace
-            self.ch1 = self.RP21.ReadTagV('Data_out1', 0, Ndata)
-            self.HwOff()
-            #self.RP21.Halt()
-        
-        else:
-            raise ValueError("No recognized hardware to use here")
+        self.openHardware()
+        data = self.backend.play(wavel, waver, samplefreq, postduration,
+                                 stop=lambda: not self.PPGo) # check for stop while waiting
+        if data is not None:
+            (self.ch1, self.ch2) = data
     
     def retrieveInputs(self):
         return(self.ch1, self.ch2)
+
+# filter an input channel as it is acquired (filt is a Utility.StreamingFilter;
+# None removes it); retrieveFiltered returns the filtered data of the last trial
+    def setInputFilter(self, chan, filt):
+        self.openHardware()
+        self.backend.setInputFilter(chan, filt)
+
+    def retrieveFiltered(self, chan=0):
+        if self.backend is None:
+            return None
+        return self.backend.filteredInput(chan)
         
     def HwOff(self): # turn the hardware off if you can.
-        if self.hardware == 'pyaudio':
-            self.stream.stop_stream()
-            self.stream.close()
-            self.audio.terminate()
-        
-        if self.hardware == 'nidaq':
-            self.task.stop()
-            self.setAttens()
-            self.RP21.Halt()
-            
-# clip data to max value (+/-) to avoid problems with daqs
-    def clip(self, data, maxval):
-        if self.debugFlag:
-            print "PySounds.clip: max(data) = %f, %f and maxval = %f" % (
-                max(data), min(data), maxval)
-        clip = 0
-        u = np.where(data >= maxval)
-        ul = list(np.transpose(u).flat)
-        if len(ul) > 0:
-            data[ul] = maxval
-            clip = 1 # set a flag in case we want to know
-            if self.debugFlag:
-                print "PySounds.clip: clipping %d positive points" % (len(ul))
-        minval = -maxval
-        v = np.where(data <= minval)
-        vl = list(np.transpose(v).flat)
-        if len(vl) > 0:
-            data[vl] = minval
-            clip = 1
-            if self.debugFlag:
-                print "PySounds.clip: clipping %d negative points" % (len(vl))
-        if self.debugFlag:
-            print "PySounds.clip: clipped max(data) = %f, %f and maxval = %f" % (
-                    max(data), min(data), maxval)
-        return (data, clip)
-        
-################################################################################
-# the following was taken from #http://hlzr.net/docs/pyaudio.html
-# it is used for reading and writing to the system audio devie
-#
-################################################################################
-    def write_array(self, data):
-        """
-        Outputs a numpy array to the audio port, using PyAudio.
-        """
-        # Make Buffer
-        buffer_size = struct.calcsize('@f') * len(data)
-        output_buffer = ctypes.create_string_buffer(buffer_size)
-    
-        # Fill Up Buffer
-        #struct needs @fffff, one f for each float
-        format = '@' + 'f'*len(data)
-        struct.pack_into(format, output_buffer, 0, *data)
-    
-        # Shove contents of buffer out audio port
-        self.stream.write(output_buffer)
-    
-    def read_array(self, size, channels=1):
-        input_str_buffer = np.zeros((size, 1)) # self.stream.read(size)
-        input_float_buffer = struct.unpack('@' + 'f'*size*channels, input_str_buffer)
-        return np.array(input_float_buffer)
+        if self.backend is not None:
+            self.backend.off()
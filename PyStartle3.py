@@ -64,9 +64,10 @@ Works with Anaconda distribution on Mac OS X and Windows.
     You must obtain these libraries from TrollTech directly, under their license
     to use the program.
 """
+import time
+STARTUP_T0 = time.time() # for the startup timing report
 import sys, re, os
 import datetime
-import time
 import ConfigParser
 import gzip
 import cPickle
@@ -82,11 +83,20 @@ import MpyqtHelpers as MPH
 from random import sample
 # our sound handling module (includes hardware detection and signal generation)
 import PySounds
-from Utility import Utility 
+import Hardware
+from Utility import Utility, StreamingFilter, filterCache
+import StartleData
+import StartleAnalysis
+import StimulusBank
+import StimulusGraph
+import AnalysisWorker
 
 from PyStartle3_gui import Ui_MainWindow
 
-Sounds = PySounds.PySounds() # instance of sound - and connects to the hardware
+IMPORT_TIME = time.time() - STARTUP_T0
+# instance of sound. The hardware is not opened until the first acquisition
+# (see PrePulseStart), so analysis-only use never touches the drivers.
+Sounds = PySounds.PySounds()
 Utils = Utility()
 MPHL = MPH.MPH()
 
@@ -95,14 +105,15 @@ class PyStartle(QtGui.QMainWindow):
     Main class - instantiates GUI and connects to hardware
     """
     
-    def __init__(self):
-        (self.hardware, self.out_sampleFreq, self.in_sampleFreq) = Sounds.getHardware()
-        print "PyStartle is running with output hardware: %s" % (self.hardware)
+    def __init__(self, analysisOnly=False):
         """ In the constructor get the application
             started by constructing a basic QApplication with
             its __init__ method, then adding our slot/signal connections
             and finally starting the exec_loop. """""
         QtGui.QDialog.__init__(self)
+        t0 = time.time()
+        self.analysisOnly = analysisOnly # no stimulation/acquisition: hardware is never opened
+        (self.hardware, self.out_sampleFreq, self.in_sampleFreq) = (None, 100000.0, 44100.0)
         self.debugFlag = False # control printing debug statements.
         self.AutoSave = True
         self.configfile = 'pystartle3.cfg'   # specific to this version.
@@ -110,6 +121,7 @@ class PyStartle(QtGui.QMainWindow):
         self.in_sampleFreq = 44100.0
         self.recentFiles = deque() # makes a que; in python 2.6, can add # of elements
         self.ch1 = []
+        self.fch1 = None # ch1 filtered as it was acquired (None if it was not)
         self.ch2 = []
         self.ITI = 10.0
         self.ITI_List = []
@@ -131,6 +143,18 @@ class PyStartle(QtGui.QMainWindow):
         self.CurrentTab = 0 # set a default current tab - left most entry
         self.Signal_PlotLegend = None
         self.Response_PlotLegend = None
+        self.DataWriter = None # binary session file, open while acquiring
+        self.StimBank = None # stimuli for the current run
+        self.StimPlan = None # renders each trial's stimulus from the run's stimulus graph
+        self.OnlineStats = StartleAnalysis.OnlineDiscrimination() # gap/no-gap statistics during a run
+        self.NoiseMethod = 'fft' # bandpass noise made with exact bands ('iir' for the elliptic filter)
+        self.Analysis_ZeroPhase = False # filter the responses forward and backward (no latency shift)
+        self.StimBankBackground = True # build the stimuli in a separate thread
+        self.session = None # session being analyzed
+        self.AnalysisWorker = AnalysisWorker.AnalysisWorker(self) # reads and analyzes off the GUI thread
+        self.a_ch1 = np.zeros((0, 0)) # (trials, points) response data
+        self.fa_ch1 = None # filtered response data from the last analysis
+        self.fa_key = None # (data, LPF, HPF, zerophase) that fa_ch1 was filtered from
         
         self.ui = Ui_MainWindow() # this is the ONE THING
         self.ui.setupUi(self)
@@ -150,6 +174,8 @@ class PyStartle(QtGui.QMainWindow):
         self.ui.Analysis_ReRead.clicked.connect(self.Analysis_ReRead)
         self.ui.Analysis_Test.clicked.connect(self.Analysis_Test)
         self.ui.Analysis_Analyze.clicked.connect(self.Analyze_Data)
+        self.ui.Analysis_LPF.valueChanged.connect(self.Analysis_FilterChanged)
+        self.ui.Analysis_HPF.valueChanged.connect(self.Analysis_FilterChanged)
         self.ui.Analysis_lineEdit.editingFinished.connect(self.Analysis_lineEdit)
         self.ui.Annotate_Reset.clicked.connect(self.resetTable)
         self.ui.Annotate_Load.clicked.connect(self.loadAnnotation)
@@ -162,6 +188,9 @@ class PyStartle(QtGui.QMainWindow):
         self.ui.exportAsSVG.clicked.connect(self.exportAsSVG) 
         self.ui.exportAsPDF.clicked.connect(self.exportAsPDF) 
         self.ui.exportAsPNG.clicked.connect(self.exportAsPNG) 
+        if self.analysisOnly:
+            for b in [self.ui.PrePulse_Run, self.ui.ToneTest, self.ui.NoiseTest]:
+                b.setEnabled(False)
 
 
         self.ui.GraphTabs.show()
@@ -217,11 +246,38 @@ class PyStartle(QtGui.QMainWindow):
         # MPlots.setXYReport(self.ui.X_Cursor, self.ui.Y_Cursor) # link the cursor to the display
         self.readAnalysisTab()
         self.readParameters()
+        t1 = time.time()
         self.getConfig(self.configfile)
         #self.readini("pystartle.ini") # read the initialization file if it is there.
+        t2 = time.time()
         self.setMainWindow() # build the plots
         self.statusBar().showMessage("No File" )   
         self.Status('Welcome to PyStartle V2.2beta')
+        self.startupReport(IMPORT_TIME, (t1 - t0) + (time.time() - t2), t2 - t1)
+
+# report where the time went at startup (the hardware is opened later, on demand)
+    def startupReport(self, timports, tgui, tconfig):
+        msg = "Startup: imports %.0f ms, GUI %.0f ms, config %.0f ms, total %.0f ms" % (
+            1000*timports, 1000*tgui, 1000*tconfig, 1000*(time.time() - STARTUP_T0))
+        if self.analysisOnly:
+            msg = msg + " (analysis only)"
+        print msg
+        self.Status(msg)
+
+# open the hardware if this is the first acquisition, and report how long it took.
+# Returns False if the hardware is there but could not be connected.
+    def openHardware(self):
+        wasOpen = Sounds.isOpen()
+        try:
+            (self.hardware, self.out_sampleFreq, self.in_sampleFreq) = Sounds.getHardware()
+        except Hardware.HardwareError, e:
+            print "PyStartle: hardware error: %s" % (e)
+            self.Status("Hardware error: %s" % (e))
+            return False
+        if not wasOpen:
+            print "PyStartle is running with output hardware: %s" % (self.hardware)
+            self.Status("Hardware: %s (opened in %.0f ms)" % (self.hardware, 1000*Sounds.openTime))
+        return True
 
 ################################################################################
 # utility routines for Gui:
@@ -231,10 +287,12 @@ class PyStartle(QtGui.QMainWindow):
 
     def slotQuit(self):
         try:
-            if self.hardware == 'nidaq':
-                Sounds.HwOFF()
+            self.PPGo = False
+            Sounds.endSession()
+            Sounds.HwOff()
         finally:
             pass
+        self.AnalysisWorker.wait()
 #        self.slotCloseDataWindows() # should close the matplotlib windows... 
         self.saveConfig(self.configfile)
         
@@ -395,6 +453,11 @@ class PyStartle(QtGui.QMainWindow):
         self.PP_Notch_F1 = self.ui.PrePulse_Notch_F1.value()
         self.PP_Notch_F2 = self.ui.PrePulse_Notch_F2.value()
         self.PP_MultiFreq = str(self.ui.PrePulse_MultiFreq.text())  
+        try:
+            self.PP_MultiFreqList = PySounds.parseFrequencies(self.PP_MultiFreq) # Hz
+        except ValueError, e:
+            self.Status("%s; using the prepulse frequency" % (e))
+            self.PP_MultiFreqList = np.array([self.PP_Freq])
 # from the Timing and Trials tab:
         self.ITI_Var = self.ui.PrePulse_ITI_Var.value()
         self.ITI = self.ui.PrePulse_ITI.value()
@@ -437,6 +500,9 @@ class PyStartle(QtGui.QMainWindow):
 ################################################################################
 
     def PrePulseStart(self):
+        if self.analysisOnly:
+            self.Status("Analysis only: stimulation is disabled")
+            return
         if self.PPGo:
             print "already running"
             return;
@@ -445,8 +511,16 @@ class PyStartle(QtGui.QMainWindow):
 # open and build the file
 #
         dt = time.strftime('%Y%m%d%H%M')
-        self.fn = dt + "_Startle.txt"
+        self.fn = dt + "_Startle" + StartleData.FILE_EXTENSION
         self.readParameters() # get the parameters for stimulation
+        Sounds.noise.reseed() # new noise for this session; the seed is saved with the data
+        if not self.openHardware():
+            return
+        Sounds.startSession() # devices stay open and configured until the run ends
+        # the response is filtered as it comes in, for the display of each trial
+        self.readAnalysisTab()
+        Sounds.setInputFilter(0, StreamingFilter(filterCache.bandpass(self.Analysis_LPF,
+                                                 self.Analysis_HPF, self.in_sampleFreq)))
         self.TrialCounter = 0
         self.SpecMax = 0
         self.totalTrials = int(self.Trials+self.NHabTrials)
@@ -460,11 +534,18 @@ class PyStartle(QtGui.QMainWindow):
         self.Gap_List[int(self.NHabTrials):] = s
         if self.AutoSave:
             self.writeDataFileHeader(self.fn) # wait to write header until we have all the values.
-        self.Gap_StartleMagnitude = np.zeros(self.Trials)
-        self.Gap_Counter = 0
-        self.noGap_StartleMagnitude = np.zeros(self.Trials)
-        self.noGap_Counter = 0
+        self.stopStimulusBank()
+        self.StimPlan = StimulusGraph.compileGraph(self.stimulusGraph(), Sounds, self.out_sampleFreq,
+                                                   self.maxStimulusDuration())
+        self.StimBank = StimulusBank.StimulusBank(self.totalTrials, self.maxStimulusPoints(),
+                                                  self.makeTrialStimulus)
+        self.StimBank.build(background=self.StimBankBackground)
+        if self.debugFlag:
+            print "PrePulseStart: stimulus bank is %d bytes" % (self.StimBank.nbytes())
+        self.OnlineStats = StartleAnalysis.OnlineDiscrimination(self.Trials)
+        self.setOnlineStats()
         self.PPGo = True
+        Sounds.PPGo = True
         if self.debugFlag:
             print "PrePulseStart: timer starting"
         self.TrialTimer.setSingleShot(True)
@@ -477,6 +558,10 @@ class PyStartle(QtGui.QMainWindow):
         Sounds.setAttens() # attenuators down
         # Sounds.HwOff() # turn hardware off
         self.PPGo=False # signal the prepulse while loop that  we are stopping
+        Sounds.PPGo = False # and any acquisition in progress
+        self.closeDataFile()
+        self.stopStimulusBank()
+        Sounds.endSession()
         self.statusBar().showMessage("Stimulus/Acquisition Events stopped")
 
 # callback routine to stop timer when thread times out.
@@ -499,6 +584,8 @@ class PyStartle(QtGui.QMainWindow):
             self.TrialCounter = self.TrialCounter + 1
         else:
             self.PPGo = False
+            self.closeDataFile()
+            Sounds.endSession()
             self.statusBar().showMessage("Test Complete")
         if self.debugFlag:
             print "NextTrial: exiting"
@@ -512,8 +599,8 @@ class PyStartle(QtGui.QMainWindow):
 # 0 is silence
 # 1 is tone
 # 2 is bandpass noise
-# 3 is notch noise (not implemented yet)
-# 4 is multi tones (not implemented yet)
+# 3 is notch noise (bandpass noise with a notch)
+# 4 is multi tones (frequencies from PP_MultiFreq, in kHz)
 # 5 is AM tones (not implemented yet)
 # 6 is AM Noise (not implemented yet)
 # 
@@ -528,65 +615,75 @@ class PyStartle(QtGui.QMainWindow):
         if self.debugFlag:
             print "runOnePP: Entering"
         (self.hardware, self.out_sampleFreq, self.in_sampleFreq) = Sounds.getHardware()
-        if self.CN_Mode == 0:
-            cnmode = 'silence'
-            cnfreq = (self.PP_Freq, 0) # anything will do
-        if self.CN_Mode == 1 or self.CN_Mode == 4 or self.CN_Mode == 5:
-            cnmode = 'tone'
-            cnfreq = (self.PP_Freq, 0)
-        if self.CN_Mode == 2 or self.CN_Mode == 6:
-            cnmode = 'bpnoise'
-            cnfreq = (self.PP_HP, self.PP_LP)
-        if self.CN_Mode == 3:
-            cnmode = 'notchnoise' # Note: notch is embedded into a bandpass noise
-            cnfreq = (self.PP_HP, self.PP_LP, self.PP_Notch_F1, self.PP_Notch_F2)
-        # generate the conditioning stimulus and the post-prepulse stimulus
-        self.wave_outL = Sounds.StimulusMaker(mode = cnmode, duration = (self.Stim_Dur+self.PP_Dur+self.PS_Dur+self.ST_Dur),
-                                  freq = cnfreq, samplefreq = self.out_sampleFreq, delay=0, level = self.CN_Level)
-        # now tailor the conditioning stimulus
-        # this is regulated by the current Gap_List value
-        w_pp = [] # default with no prepulse
-        if self.Gap_List[self.TrialCounter]: # only make a prepulse if it is set
-            if self.PP_Mode == 0 or self.PP_GapFlag: # insert a gap
-                self.wave_outL = Sounds.insertGap(self.wave_outL, delay = self.Stim_Dur,
-                                  duration = self.PP_Dur, samplefreq = self.out_sampleFreq) # inserts the gap
-            if self.PP_Mode == 1 or self.PP_Mode ==4 or self.PP_Mode == 5: # now insert a tone
-                w_pp = Sounds.StimulusMaker(mode = 'tone', duration = self.PP_Dur, freq = (self.PP_Freq, 0),
-                                          delay=self.Stim_Dur, samplefreq = self.out_sampleFreq, level = self.PP_Level)
-                w_pp =np.append(w_pp, np.zeros(len(self.wave_outL)-len(w_pp))) # pad
-            if self.PP_Mode == 2 or self.PP_Mode == 6:  # 2 is bandpass noise
-                w_pp = Sounds.StimulusMaker(mode = 'bpnoise', duration = self.PP_Dur, freq = (self.PP_HP, self.PP_LP),
-                                    delay=self.Stim_Dur, samplefreq = self.out_sampleFreq, level = self.PP_Level)
-                w_pp =np.append(w_pp, np.zeros(len(self.wave_outL)-len(w_pp))) # pad  
-            if self.PP_Mode == 3: # 3 Notched noise
-                w_pp = Sounds.StimulusMaker(mode = 'notchnoise', duration = self.Stim_Dur,
-                                    freq = (self.PP_HP, self.PP_LP, self.Notch_F1, self.Notch_F2),
-                                    samplefreq = self.out_sampleFreq, delay=self.Stim_Dur,
-                                    level = self.PP_Level)
-                w_pp =np.append(w_pp, np.zeros(len(self.wave_outL)-len(w_pp))) # pad 
-        if len(w_pp) > 0:
-            self.wave_outL = self.wave_outL + w_pp
-        # generate the startle sound. Note that it overlaps the end of the conditioning sound...
-        self.wave_outR = Sounds.StimulusMaker(mode = 'bpnoise', delay = (self.Stim_Dur+self.PP_Dur+self.PS_Dur),
-                                       duration = self.ST_Dur, samplefreq=self.out_sampleFreq,
-                                       freq = (1000.0, 32000.0), level = self.ST_Level,
-                                       channel = 1)
-        lenL = len(self.wave_outL)
-        lenR = len(self.wave_outR)
-        if lenR > lenL:
-            self.wave_outL =np.append(self.wave_outL, np.zeros(lenR-lenL))
-        if lenL > lenR:
-            self.wave_outR =np.append(self.wave_outR, np.zeros(lenL-lenR))
+        # the stimuli for the run were made in PrePulseStart; this is just a lookup
+        (self.wave_outL, self.wave_outR) = self.StimBank.get(self.TrialCounter)
         if self.debugFlag:
             print "runOnePP: present stimulus"
         if self.StimEnable == True:
             Sounds.playSound(self.wave_outL, self.wave_outR, self.out_sampleFreq,
                              self.PostDuration)
             (self.ch1, self.ch2) = Sounds.retrieveInputs()
+            self.fch1 = Sounds.retrieveFiltered(0)
        # print 'ch1 len: ', len(self.ch1)
         if self.debugFlag:
             print "runOnePP: exiting"
 
+# the longest stimulus of the run, in msec and in output points
+    def maxStimulusDuration(self):
+        return max(self.Dur_List) + self.PP_Dur + self.PS_Dur + self.ST_Dur
+
+    def maxStimulusPoints(self):
+        return int(np.floor((self.maxStimulusDuration()/1000.0)*self.out_sampleFreq)) + 1
+
+# the source for a CN or PP mode (see above), normalized to 1
+    def modeSource(self, mode, duration):
+        if mode == 1 or mode == 5:
+            return StimulusGraph.Tone((self.PP_Freq, 0), duration)
+        if mode == 4:
+            return StimulusGraph.Tone(self.PP_MultiFreqList, duration, multi=True)
+        if mode == 2 or mode == 6:
+            return StimulusGraph.Noise((self.PP_HP, self.PP_LP), duration, method=self.NoiseMethod)
+        if mode == 3: # Note: notch is embedded into a bandpass noise
+            return StimulusGraph.Noise((self.PP_HP, self.PP_LP, self.PP_Notch_F1, self.PP_Notch_F2),
+                                       duration, mode='notchnoise')
+        return StimulusGraph.Silence(duration)
+
+# the stimulus graph for the run: the conditioning stimulus runs the whole trial
+# (to the end of the startle), with a gap and/or a prepulse at the end of the
+# conditioning period on gap trials, on the left (channel 0); the startle is on
+# the right (channel 1). 'cndur', 'gap', 'stdelay' and 'total' are set for each trial.
+    def stimulusGraph(self):
+        G = StimulusGraph
+        cndur = G.Param('cndur')
+        gap = G.Param('gap')
+        total = G.Param('total')
+        left = G.Level(self.modeSource(self.CN_Mode, total), self.CN_Level)
+        if self.PP_Mode == 0 or self.PP_GapFlag: # insert a gap
+            left = G.Gap(left, delay=cndur, duration=self.PP_Dur, cut=gap)
+        if self.PP_Mode != 0: # and the prepulse, only on gap trials
+            pp = G.Level(self.modeSource(self.PP_Mode, self.PP_Dur), self.PP_Level, enable=gap)
+            left = G.Sum([left, pp], [0.0, cndur])
+        # generate the startle sound. Note that it overlaps the end of the conditioning sound...
+        st = G.Noise((1000.0, 32000.0), self.ST_Dur, method=self.NoiseMethod)
+        right = G.Sum([G.Level(st, self.ST_Level, channel=1)], [G.Param('stdelay')])
+        return [left, right]
+
+# build the stimulus for one trial of the run: returns the (left, right) waveforms
+# (views of the render plan's buffer, valid until the next trial is made)
+    def makeTrialStimulus(self, trial):
+        stim_dur = self.Dur_List[trial]
+        Sounds.noise.setTrial(trial) # the same noise for this trial whenever it is made
+        plan = self.StimPlan
+        if plan is None:
+            plan = self.StimPlan = StimulusGraph.compileGraph(self.stimulusGraph(), Sounds,
+                                        self.out_sampleFreq, self.maxStimulusDuration())
+        waves = plan.render({'cndur': stim_dur, 'gap': self.Gap_List[trial],
+                             'stdelay': stim_dur+self.PP_Dur+self.PS_Dur,
+                             'total': stim_dur+self.PP_Dur+self.PS_Dur+self.ST_Dur})
+        if self.debugFlag:
+            print "makeTrialStimulus: sources made %d, reused %d" % plan.stats()
+        return waves
+
 ################################################################################
 #
 # plot the signal and it's power spectrum
@@ -636,6 +733,7 @@ class PyStartle(QtGui.QMainWindow):
         
         # analyze the response signal
         dprime, ratio = self.Response_Analysis(timebase= self.response_tb, signal = self.ch1,
+                               filtered = self.fch1,
                                samplefreq = samplefreq, delay=tdelay,
                                SpecPlot = self.RSpectrum_Plot,
                                SignalPlot = self.Expanded_Signal_Plot,
@@ -645,17 +743,13 @@ class PyStartle(QtGui.QMainWindow):
                                gaplist = self.Gap_List)
 
         if self.TrialCounter > 0:
-            self.ui.Discrimination_Score_Label.setText("Rd: %7.3f" % (dprime))
+            (lo, hi) = self.OnlineStats.dprimeCI()
+            if np.isnan(lo):
+                self.ui.Discrimination_Score_Label.setText("Rd: %7.3f" % (dprime))
+            else:
+                self.ui.Discrimination_Score_Label.setText("Rd: %7.3f [%.2f, %.2f]" % (dprime, lo, hi))
             self.ui.Rd_Dial.setValue(int(100*dprime))
         
-    def getSelectionIndices(self, x, xstart, xend):
-        astart = np.where(x >= xstart)
-        aend = np.where (x <= xend)
-        s0 = set(np.transpose(astart).flat)
-        s1 = set(np.transpose(aend).flat)
-        xpts = list(s1.intersection(s0))
-        return (xpts)
-    
     def Write_Data(self):
         self.writeDataFileHeader('test.dat')
         
@@ -687,6 +781,8 @@ class PyStartle(QtGui.QMainWindow):
         filedict['PP_Notch_F2'] = self.PP_Notch_F2
         filedict['PP_MultiFreq'] = self.PP_MultiFreq
         filedict['PP_GapFlag'] = self.PP_GapFlag
+        filedict['NoiseSeed'] = Sounds.noise.seed # each trial's noise can be made again from this
+        filedict['NoiseMethod'] = self.NoiseMethod
 # from the Timing and Trials tab:
         filedict['ITI_Var'] = self.ITI_Var 
         filedict['ITI'] = self.ITI
@@ -696,27 +792,39 @@ class PyStartle(QtGui.QMainWindow):
         filedict['Analysis_Start'] = self.Analysis_Start 
         filedict['Analysis_Duration'] = self.Analysis_Duration
         filedict['Analysis_HPF'] = self.Analysis_HPF
+        filedict['Analysis_ZeroPhase'] = self.Analysis_ZeroPhase
         filedict['Analysis_LPF'] = self.Analysis_LPF          
         print "Writing File: %s" % (filename)
-        hdat = open(filename, 'w')
-        hdat.write("%s \n" % (filedict))
-        hdat.write("%s \n" % (filedict_gap)) # write in separate lines
-        hdat.close()
-        
+        self.closeDataFile()
+        self.DataWriter = StartleData.SessionWriter(filename, filedict,
+                                        filedict_gap['GapList'],
+                                        self.maxResponsePoints(), self.in_sampleFreq)
+
+# longest response trace we can get back in a run: the longest stimulus
+# (conditioning duration plus its variation) and the post-startle recording
+    def maxResponsePoints(self):
+        maxdur = (self.CN_Dur + 0.5*self.CN_Var + self.PP_Dur + self.PS_Dur +
+                  self.ST_Dur)/1000.0 + self.PostDuration
+        return int(np.ceil(maxdur*self.in_sampleFreq))
+
+# append one trial record (in mV) to the open session file
     def AppendData(self, filename):
-        hdat = open(filename, 'a')
-        datainfo = {}
-        datainfo['Points'] = len(self.response_tb)
-        datainfo['inSampleFreq'] = self.in_sampleFreq
-        datainfo['outSampleFreq'] = self.out_sampleFreq
-        datainfo['GapMode'] = self.Gap_List[self.TrialCounter]
-        datainfo['ITI'] = self.ITI_List[self.TrialCounter]
-        datainfo['CNDur'] = self.Dur_List[self.TrialCounter]
-        hdat.write("%s \n" % (datainfo))
-        for i in range(0, len(self.response_tb)):
-            hdat.write("%f %f %f\n" % (self.response_tb[i], 1000*self.ch1[i],
-                                       1000*self.ch2[i]))
-        hdat.close()
+        if self.DataWriter is None:
+            self.writeDataFileHeader(filename)
+        self.DataWriter.append((1000.0*np.asarray(self.ch1), 1000.0*np.asarray(self.ch2)),
+                               gap=self.Gap_List[self.TrialCounter],
+                               iti=self.ITI_List[self.TrialCounter],
+                               cndur=self.Dur_List[self.TrialCounter],
+                               outsamplefreq=self.out_sampleFreq)
+
+    def stopStimulusBank(self):
+        if self.StimBank is not None:
+            self.StimBank.stop()
+
+    def closeDataFile(self):
+        if self.DataWriter is not None:
+            self.DataWriter.close()
+            self.DataWriter = None
 
     def Analysis_Test(self):
         self.readParameters()
@@ -726,7 +834,8 @@ class PyStartle(QtGui.QMainWindow):
         rate = 1000.0/samplefreq
         signal = np.random.normal(0, 1, npts)
         (Rspectrum, Rfreqs) = Utils.pSpectrum(signal, float(rate/1000.0)) # rate  (1/ms) is converted to Hz
-        fa = Utils.SignalFilter(signal, self.Analysis_LPF, self.Analysis_HPF, samplefreq)
+        fa = Utils.SignalFilter(signal, self.Analysis_LPF, self.Analysis_HPF, samplefreq,
+                                zerophase=self.Analysis_ZeroPhase)
         (fRspectrum, fRfreqs) = Utils.pSpectrum(fa, float(rate/1000.0)) # rate  (1/ms) is converted to Hz
         mpl.plot(Rfreqs, Rspectrum, pen=pg.mkPen('w'))
         mpl.plot(fRfreqs, fRspectrum, pen=pg.mkPen('r'))
@@ -739,9 +848,10 @@ class PyStartle(QtGui.QMainWindow):
     def Analysis_Read(self, filename=None):
         
         print 'filename: ', filename
-        self.a_t = [] 
-        self.a_ch1 = [] 
-        self.a_ch2 = [] 
+        self.session = None
+        self.a_ch1 = np.zeros((0, 0))
+        self.a_ch2 = np.zeros((0, 0))
+        self.a_points = np.zeros(0, dtype=int)
         self.gapmode = []
         self.delaylist = []
         self.ITI_List = []
@@ -751,89 +861,54 @@ class PyStartle(QtGui.QMainWindow):
         if filename == None or not filename:
             fd = QtGui.QFileDialog(self)
             self.inFileName = str(fd.getOpenFileName(self, "Get input file", "",
-                                                     "data files (*.txt)"))
+                                                     "data files (*%s *.txt)" % (StartleData.FILE_EXTENSION)))
         else:
             self.inFileName = filename
         print self.inFileName
-        try:
-            hstat = open(self.inFileName,"r")
-            (p, f)  = os.path.split(self.inFileName)
-            self.setMainWindow(text=f)
-        except IOError:
-            self.Status( "%s not found" % (self.inFileName))
-            return
+        self.statusBar().showMessage("Reading %s" % (self.inFileName))
+        # the file is read in the background; a file chosen while another is
+        # still being read or analyzed replaces it
+        self.AnalysisWorker.submit(readSessionJob, (self.inFileName,), done=self.Analysis_Loaded,
+                                   progress=self.statusBar().showMessage,
+                                   failed=lambda e: self.Status("%s not read: %s" % (self.inFileName, e)))
+
+# the session file has been read (by readSessionJob)
+    def Analysis_Loaded(self, session):
+        (p, f)  = os.path.split(self.inFileName)
+        self.setMainWindow(text=f)
         if self.inFileName not in self.recentFiles:
             self.recentFiles.appendleft(self.inFileName)
-        lineno = 0
-        state = 0 # initial state
-                    # states:
-                    # 0 - nothing read
-                    # 1 = first line read
-                    # 2 = record "header" line read
-                    # 3 = reading data
-        parse =  re.compile("(^([\-0-9.]*) ([\-0-9.]*) ([\-0-9.]*))")
-        reccount = 1
-
-        header_linecount = 0
-        lineno = 0
-        for line in hstat:
-            lineno = lineno + 1
-            if state == 0:
-                if header_linecount == 0:  # first line has parameters for stimulus etc. 
-                    self.statusBar().showMessage("Reading Header" )   
-                    self.paramdict = Utils.long_Eval(line)
-                    header_linecount = 1
-                    continue
-                if header_linecount == 1:  # second header line is a dict with gap list status falgs
-                    self.paramdict_gap = Utils.long_Eval(line)
-                    state = 1
-                    header_linecount = 0
-                continue
-            if state == 1:  # third line begins the data - stimulus parameters are here, so extract
-                self.headerdict =  Utils.long_Eval(line)
-                self.npts = self.headerdict['Points']
-                self.samplefreq = 1.0/float(self.headerdict['SampleRate'])
-                if self.headerdict.has_key('GapMode'): # build gap mode array
-                    self.gapmode.append(self.headerdict['GapMode'])
-                else:
-                    self.gapmode.append(False)
-                if self.headerdict.has_key('CNDur'): # build duration  (delay to startle) array
-                    self.delaylist.append(self.headerdict['CNDur'] +
-                                          self.paramdict['PP_Dur'] + self.paramdict['PS_Dur'])
-                if self.headerdict.has_key('ITI'): # build an ITI list.
-                    self.ITI_List.append(self.headerdict['ITI'])
-                reccount += 1
-                self.statusBar().showMessage("Reading Trial %d" % (reccount) )   
-                state = 2
-                i = 0
-                t = np.zeros(self.npts)
-                ch1 = np.zeros(self.npts)
-                ch2 = np.zeros(self.npts)
-                continue
-            if state == 2:  # waveforms
-                    mo = parse.search(line)
-                    t[i] = float(mo.group(2))
-                    ch1[i] = float(mo.group(3))
-                    ch2[i] = float(mo.group(4))
-                    i = i + 1
-                    if i >= self.npts:
-                        self.a_t.append(np.array(t))
-                        # filter the data as it comes in
-                        self.a_ch1.append(np.array(ch1))
-                        self.a_ch2.append(np.array(ch2))
-                        state = 1 # reset the state to read the next points list
-        hstat.close()
+        self.paramdict = session.params
+        self.paramdict_gap = {'GapList': session.gaplist}
+        self.headerdict = {'Points': session.npoints(), 'SampleRate': session.samplefreq}
+        self.npts = session.npoints()
+        self.samplefreq = 1.0/session.samplefreq
+        # (trials, points) views onto the mapped file; the timebase is computed
+        # from the sample rate when it is needed.
+        self.session = session
+        self.a_ch1 = session.ch1()
+        self.a_ch2 = session.ch2()
+        self.a_points = session.points()
+        self.gapmode = list(session.gapmode())
+        self.delaylist = list(session.records['cndur'] + self.paramdict['PP_Dur'] +
+                              self.paramdict['PS_Dur'])
+        self.ITI_List = list(session.records['iti'])
         self.statusBar().showMessage("Done Reading")   
         if self.loadAnnotation(): # see if there is an associated annotation file.
             self.updateAnnotateTime()
         self.Analyze_Data()
 
+# a filter corner changed: analyze the session again (if one is loaded)
+    def Analysis_FilterChanged(self, value):
+        if self.session is not None and not self.PPGo:
+            self.Analyze_Data()
+
     def Analysis_ReRead(self):
         if self.recentFiles is not []:
             self.Analysis_Read(filename=self.recentFiles[0]) # get the top most file
         
     def Analyze_Data(self):
-        ds = len(self.a_t)
+        ds = self.a_ch1.shape[0]
         if ds == 0:
             print "Analyze_Data: No data in file."
             return
@@ -841,130 +916,62 @@ class PyStartle(QtGui.QMainWindow):
         self.readParameters() # to be sure we have "showspectrum"
         self.readAnalysisTab()
         self.getRejectTrials()
-        rejectwindow = self.Analysis_Baseline
-        srate = 1000.0/float(self.headerdict['SampleRate']) # sample rate is in msec/point.
-        sfreq = 1.0/srate
-        # note: must clip to the part of the dataset that we need - e.g., the post-startle section        
-        stdur = int(self.Analysis_Duration/srate) #  points after startle
-        # prepare to plot all traces
-        rows = int(np.sqrt(ds))
-        cols = int(ds/rows)
-        if rows*cols < ds:
-            cols += 1
-        
-        # first filter the data set (only the response channel, not the microphonse)
-        self.fa_ch1 = [] # list of channel data (elements are numpy arrays)
-        for k in range(0, ds):
-            fa = Utils.SignalFilter(self.a_ch1[k], self.Analysis_LPF, self.Analysis_HPF,
-                 float(self.headerdict['SampleRate']))
-            self.fa_ch1.append((fa).astype('float32'))
-        
-        sum_nogap = np.zeros(stdur)
-        sum_gap = np.zeros(stdur)
-        N_gap = 0
-        N_nogap = 0
-        tb = np.arange(0,(self.Analysis_Duration/srate),srate)*1000.0 # in msec.
-        NTrials = int(self.paramdict['Trials'])
-        self.Startle_Analyze(trialcounter=0, ntrials=NTrials) # with trial counter set to 0, initializes analysis
-        self.SpecMax = 0
-        bli = np.array([])
-        sigi = np.array([])
-        for i in range(0, ds):
-            thislen = self.a_t[i].shape
-            if thislen[0] <= 0:
-                break
-            ststart = int(self.delaylist[i]/srate) # delay is in msec
-            stend = ststart+stdur
-            if i < int(self.paramdict['NHabTrials']):
-                continue
-            rjend = ststart + int(rejectwindow/srate)
-            rpts = range(ststart, rjend)
-            if rjend > self.fa_ch1[i].shape[0]: # check for truncated records
-                break
-            bli = np.append(bli, np.std(self.fa_ch1[i][rpts]))
-            sigi = np.append(sigi, np.std(self.fa_ch1[i][ststart:stend]))
-        avgbl = np.mean(bli)
-        avgsig = np.mean(sigi)
-        print "\nAverage BL: %f, Average sig: %f on %d trials" % (avgbl, avgsig, len(bli))
-
-        ds = i # only include plots that are complete.
-        k = 0
-        plt = [[]]*(ds)
-        # for i in range(0, rows):
-        #     for j in range(0, cols):
-        #         if k >= ds:
-        #             continue
-        #         if self.gapmode[k]:
-        #             pline = 'r' # with prepulse, red
-        #         else:
-        #             pline = 'c' # with nogap, cyan
-        #         if k < self.paramdict['NHabTrials']: # force to grey
-        #             pline = 'darkgray'
-        #         ststart = int(self.delaylist[k]/srate) # delay is in msec
-        #         stend = ststart+stdur
-        #         if stend > shape(self.a_t[k])[0]: # Handle truncated data sets.
-        #             break
-        #         k = k + 1
-        
-        nSuccessfulTrials = 0
-        for i in range(int(self.paramdict['NHabTrials']), ds):  # start after habituation trias
-            if self.a_t[i].shape[0] == 0: # no data ? 
-                break
-            ststart = int(self.delaylist[i]/srate) # delay is in msec
-            stend = ststart+stdur
-            rjend = ststart + int(rejectwindow/srate)
-            if rjend > self.a_t[i].shape[0]:
-                break # protect against truncated record by stopping analysis
-            rpts = range(ststart, rjend)
-            #print "Analyze: rpts = %d-%d" % (min(rpts), max(rpts))
-            bl = np.std(self.fa_ch1[i][rpts])
-            sig = np.std(self.fa_ch1[i][ststart:stend])
-            if i in self.RejectedTrials:
-                print "Rejecting Trial: %d  based on Behavior/Orientation/Location" % (i)
-                self.reColor(plt[i], self.gapmode[i])
-                continue
-            if bl > self.Analysis_BaselineStd * avgbl:
-                print "Rejecting Trial: %d  baseline stdev is too big: %f" % (i, bl)
-                self.reColor(plt[i], self.gapmode[i])
-                continue
-            if sig > self.Analysis_WaveformStd * avgsig:
-                print "Rejecting Trial: %d  signal stdev is too big: %f" % (i, sig)
-                self.reColor(plt[i], self.gapmode[i])
-                continue
-            if sig < self.Analysis_WaveformMinStd * avgsig:
-                print "Rejecting Trial: %d  signal stdev is too SMALL: %f" % (i, sig)
-                self.reColor(plt[i], self.gapmode[i])
-                continue
-            # trial by trial - updates dprime
-            nSuccessfulTrials += 1
-            dprime, ratio = self.Response_Analysis(signal=self.fa_ch1[i][ststart:stend],
-                                  samplefreq=sfreq,
-                                  ResponsePlot=None, # self.Discrimination_Plot,
-                                  SignalPlot = self.Expanded_Signal_Plot,
-                                  SpecPlot = self.RSpectrum_Plot,
-                                  trialcounter=i,
-                                  ntrials=NTrials,
-                                  gaplist = self.gapmode, okTrials=nSuccessfulTrials)
-            if self.gapmode[i]:
-                try:
-                    sum_gap = sum_gap + np.array(self.fa_ch1[i][ststart:stend])
-                    N_gap += 1
-                except:
-                    pass
-            else:
-                try:
-                    sum_nogap = sum_nogap + np.array(self.fa_ch1[i][ststart:stend])
-                    N_nogap += 1
-                except:
-                    pass
+        sfreq = float(self.headerdict['SampleRate'])
+        # the filtered data are reused unless the data or the filter changed
+        # (e.g., when only the window or the rejection criteria did)
+        key = (self.a_ch1, self.Analysis_LPF, self.Analysis_HPF, self.Analysis_ZeroPhase)
+        filtered = None
+        if self.fa_key is not None and self.fa_key[0] is key[0] and self.fa_key[1:] == key[1:]:
+            filtered = self.fa_ch1
+        # the analysis is done on all trials at once, in the background; a new
+        # analysis (e.g., after a filter corner is changed) cancels the one running
+        args = (self.a_ch1, self.a_points, self.gapmode, self.delaylist, sfreq,
+                dict(LPF=self.Analysis_LPF, HPF=self.Analysis_HPF,
+                     duration=self.Analysis_Duration,
+                     rejectwindow=self.Analysis_Baseline,
+                     nhab=int(self.paramdict['NHabTrials']),
+                     baselineStd=self.Analysis_BaselineStd,
+                     waveformStd=self.Analysis_WaveformStd,
+                     waveformMinStd=self.Analysis_WaveformMinStd,
+                     rejected=self.RejectedTrials,
+                     zerophase=self.Analysis_ZeroPhase,
+                     filtered=filtered))
+        self.AnalysisWorker.submit(analyzeSessionJob, args,
+                                   done=lambda r, key=key: self.showAnalysis(r, key),
+                                   progress=self.statusBar().showMessage,
+                                   failed=lambda e: self.Status("Analysis failed: %s" % (e)))
+
+# render the result of an analysis
+    def showAnalysis(self, r, key=None):
+        self.statusBar().showMessage("Analysis done")
+        sfreq = float(self.headerdict['SampleRate'])
+        self.analysisResult = r
+        self.fa_ch1 = r.filtered
+        self.fa_key = key
+        print "\nAverage BL: %f, Average sig: %f on %d trials" % (r.avgBaseline,
+                                        r.avgSignal, np.sum(r.analyzed))
+        for (i, reason, value) in r.rejectedTrials():
+            print "Rejecting Trial: %d  %s: %f" % (i, reason, value)
+        self.Gap_StartleMagnitude = r.Gap_StartleMagnitude
+        self.noGap_StartleMagnitude = r.noGap_StartleMagnitude
+        self.Gap_mean, self.Gap_std = r.Gap_mean, r.Gap_std
+        self.noGap_mean, self.noGap_std = r.noGap_mean, r.noGap_std
+        self.Gap_Counter, self.noGap_Counter = r.nGap, r.nNoGap
+        if self.ShowSpectrum and np.any(r.accepted): # spectrum of the last accepted trial
+            last = np.nonzero(r.accepted)[0][-1]
+            (Rspectrum, Rfreqs) = Utils.pSpectrum(1000.0*r.window[last], sfreq)
+            self.SpecMax = max(Rspectrum)
+            self.RSpectrum_Plot.plot(Rfreqs[1:], 1000.0*Rspectrum[1:], pen=pg.mkPen('y'), clear=True)
+            self.RSpectrum_Plot.setXRange(10.0, 1000.0)
+        self.ui.Discrimination_Score_Label.setText(('d \' = %9.3f' % r.dprime))
         # final signal plots
-        self.sum_gap = 1000.0*sum_gap/float(N_gap)
-        self.sum_nogap = 1000.0*sum_nogap/float(N_nogap)
-        self.plotWaveform(self.Expanded_Signal_Plot, tb, ststart, stend)
+        self.sum_gap = 1000.0*r.gapAverage
+        self.sum_nogap = 1000.0*r.noGapAverage
+        self.plotWaveform(self.Expanded_Signal_Plot, r.tb)
         self.plotResponse(self.Discrimination_Plot)
 
-    def plotWaveform(self, signalPlot, tb, ststart, stend):
-        t_startle = tb[0:(stend - ststart)]/1000.0
+    def plotWaveform(self, signalPlot, tb):
+        t_startle = tb # msec
         tbase = np.arange(0, max(t_startle))
         zline = 0.0 * tbase
         if self.Signal_PlotLegend is not None:
@@ -990,7 +997,7 @@ class PyStartle(QtGui.QMainWindow):
           plt.setPen(pg.mkPen((0, 128, 128, 256)))
 
 
-    def Response_Analysis(self, timebase=None, signal=None,
+    def Response_Analysis(self, timebase=None, signal=None, filtered=None,
                                samplefreq=44100, delay=0, SpecPlot=None,
                                SignalPlot=None, ResponsePlot=None,
                                trialcounter=0,
@@ -1000,6 +1007,8 @@ class PyStartle(QtGui.QMainWindow):
                                okTrials=0):
         """
         response analysis for a single trace...
+        filtered, if given, is the trace filtered as it was acquired; it is
+        what is plotted (the magnitude is still taken from signal)
         """
                                
         if self.debugFlag:
@@ -1020,14 +1029,17 @@ class PyStartle(QtGui.QMainWindow):
             timebase = np.arange(0, len(signal))/samplefreq
         ana_windowstart = (delay + self.Analysis_Start)
         ana_windowend = (delay + self.Analysis_End)
-        apts = range(0, len(signal))
-        t0 = timebase[apts[0]] - self.Analysis_Start/1000.0
+        apts = slice(0, len(signal))
+        t0 = timebase[0] - self.Analysis_Start/1000.0
         if SignalPlot is not None:
             if gaplist[trialcounter]:
                 pline = pg.mkPen('r') # with prepulse, red
             else:
                 pline = pg.mkPen('g')  # without - green 
-            SignalPlot.plot(timebase[apts]-t0, 1000.0*signal[apts], pen=pline, clear=True)
+            shown = signal
+            if filtered is not None and len(filtered) == len(signal):
+                shown = filtered
+            SignalPlot.plot(timebase[apts]-t0, 1000.0*shown[apts], pen=pline, clear=True)
         dprime, ratio = self.Startle_Analyze(timebase=timebase, signal=signal,
                                       startdelay=0.0,
                                       rejectwindow = 10,
@@ -1050,53 +1062,37 @@ class PyStartle(QtGui.QMainWindow):
         dprime = 0.0
         ratio = 0.0
         if trialcounter == 0: # initialize the trials.
-            self.Gap_mean = 0.0
-            self.Gap_std = 0.0
-            self.noGap_mean = 0.0
-            self.noGap_std = 0.0
-            self.Gap_Counter = 0
-            self.Gap_StartleMagnitude = np.array([])
-            self.noGap_StartleMagnitude = np.array([])
-            self.noGap_Counter = 0
+            self.OnlineStats = StartleAnalysis.OnlineDiscrimination(ntrials)
+            self.setOnlineStats()
             self.SpecMax = 0.0
 
             return dprime, ratio
 
         self.readAnalysisTab()
-        apts = self.getSelectionIndices(timebase, startdelay/1000.0,
-                                        (startdelay+self.Analysis_End)/1000.0)
-        apts = range(0, len(timebase))
-        rpts = self.getSelectionIndices(timebase, 0, rejectwindow)
+        apts = slice(0, len(timebase)) # the magnitude is of the whole trace
         if trialcounter > 0 : # once we are past the habituation phase
-            if gaplist[trialcounter]:  # for trials with gaps
-                try:
-                    self.Gap_StartleMagnitude =np.append(self.Gap_StartleMagnitude,
-                         np.sqrt(np.mean(signal[apts]**2.0)))
-                    self.Gap_mean = np.mean(self.Gap_StartleMagnitude)
-                    if self.Gap_Counter >= 1 :
-                        self.Gap_std = np.std(self.Gap_StartleMagnitude)
-                    self.Gap_Counter = self.Gap_Counter + 1
-                except:
-                    print 'Startle_Analyze: error in gaplist True, trial %d' % (trialcounter)
-            else:
-                try:
-                    self.noGap_StartleMagnitude =np.append(self.noGap_StartleMagnitude,
-                         np.sqrt(np.mean(signal[apts]**2.0)))
-                    self.noGap_mean = np.mean(self.noGap_StartleMagnitude)
-                    if self.noGap_Counter >= 1 :
-                        self.noGap_std = np.std(self.noGap_StartleMagnitude)
-                    self.noGap_Counter = self.noGap_Counter + 1
-                except:
-                    print 'Startle_Analyze: error in gaplist False, trial %d' % (trialcounter)
-# now calculate the d'
-            if self.noGap_std != 0 and self.Gap_std != 0 :
-                dprime = (self.noGap_mean-self.Gap_mean)/(np.sqrt(self.noGap_std**2 + self.Gap_std**2))
-                ratio = self.Gap_mean/self.noGap_mean
+            try:
+                self.OnlineStats.add(np.sqrt(np.mean(signal[apts]**2.0)), gaplist[trialcounter])
+            except:
+                print 'Startle_Analyze: error in gaplist %s, trial %d' % (gaplist[trialcounter], trialcounter)
+            self.setOnlineStats()
+# now the d' (updated with the trial, not recomputed from all of them)
+            dprime = self.OnlineStats.dprime()
+            ratio = self.OnlineStats.ratio()
             #print "Startle_Analyze: gap: %f +/- %f,, nogap: %f +/- %f  :::: dprime = %f" % (
             #       self.Gap_mean, self.Gap_std, self.noGap_mean, self.noGap_std, dprime)
         
         return dprime, ratio
 
+# copy the running gap/no-gap statistics to the attributes used for display
+    def setOnlineStats(self):
+        online = self.OnlineStats
+        self.Gap_StartleMagnitude = online.magnitudes(True)
+        self.noGap_StartleMagnitude = online.magnitudes(False)
+        self.Gap_mean, self.Gap_std = online.stats[True].mean, online.stats[True].std()
+        self.noGap_mean, self.noGap_std = online.stats[False].mean, online.stats[False].std()
+        self.Gap_Counter, self.noGap_Counter = online.stats[True].n, online.stats[False].n
+
     def Analysis_lineEdit(self):
         txt = self.ui.Analysis_lineEdit.text() # get the text
         if len(txt) > 0:
@@ -1244,6 +1240,7 @@ class PyStartle(QtGui.QMainWindow):
         config.set('Analysis', 'end', self.Analysis_End)
         config.set('Analysis', 'LPF', self.Analysis_LPF)
         config.set('Analysis', 'HPF', self.Analysis_HPF)
+        config.set('Analysis', 'zerophase', self.Analysis_ZeroPhase)
         config.add_section('RecentFiles')
         nf = len(self.recentFiles)
         if nf > 8:
@@ -1267,6 +1264,9 @@ class PyStartle(QtGui.QMainWindow):
         self.Analysis_End = config.getfloat('Analysis', 'end')
         self.Analysis_LPF = config.getfloat('Analysis', 'LPF')
         self.Analysis_HPF = config.getfloat('Analysis', 'HPF')
+        self.Analysis_ZeroPhase = False
+        if config.has_option('Analysis', 'zerophase'):
+            self.Analysis_ZeroPhase = config.getboolean('Analysis', 'zerophase')
         self.recentFiles = deque()
         nf = config.getint('RecentFiles', 'nfiles')
         for i in range(0, nf):
@@ -1537,6 +1537,17 @@ class PyStartle(QtGui.QMainWindow):
             nt = nt + 1
 
 #-------------------------------------------------------------------------------
+# The background jobs for the analysis (see AnalysisWorker): called in the
+# worker thread with check, which reports progress and stops a cancelled job.
+def readSessionJob(check, filename):
+    check("Reading %s" % (filename))
+    # binary session files load directly; old text files go through the converter
+    return StartleData.loadSession(filename, mmap=True)
+
+def analyzeSessionJob(check, data, points, gapmode, delays, samplefreq, kwargs):
+    return StartleAnalysis.analyzeSession(data, points, gapmode, delays, samplefreq,
+                                          progress=check, **kwargs)
+
 # a little class to handle the trials and load/save the data state.
 class TrialData(object):
     """ Holds information about performance on ONE trial """
@@ -1661,9 +1672,13 @@ class ComboItem(Qt.QTableWidgetItem):
 #
 
 if __name__ == "__main__":
-# check the hardware first
+# the hardware is opened at the first run, unless --analysis is given, in which case
+# it is never opened; --simulate uses the simulated hardware instead
+    analysisOnly = '--analysis' in sys.argv
+    if '--simulate' in sys.argv:
+        Sounds.simulate = True
     app = QtGui.QApplication(sys.argv)
-    MainWindow = PyStartle()
+    MainWindow = PyStartle(analysisOnly=analysisOnly)
     MainWindow.show()
     sys.exit(app.exec_())
     
\ No newline at end of file
@@ -0,0 +1,258 @@
+"""
+SimulatedDevices.py - stand-ins for the NI and TDT hardware
+
+These classes answer the same calls that PySounds makes on the NI-DAQmx
+task, the PA5 attenuators and the RP2.1 processor, so that the acquisition
+path can be run and timed on a machine without the hardware (e.g., Linux).
+Data become available at the sample rate, in real time divided by timescale
+(timescale=None makes everything available at once).
+
+StartleResponder synthesizes the input the RP2.1 would record: a damped
+oscillation after the startle stimulus, with a realistic latency, trial to
+trial variability, and a smaller response when the startle is preceded by a
+gap or a prepulse; the second (microphone) channel picks up the stimulus.
+"""
+# Paul B. Manis, Ph.D.
+# UNC Chapel Hill
+# Department of Otolaryngology/Head and Neck Surgery
+# Supported by NIH Grants DC000425-22 and DC004551-07 to PBM.
+#
+"""
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+import numpy as np
+
+# values of the NI-DAQmx constants used by PySounds
+Val_Volts = 10348
+Val_Rising = 10280
+Val_FiniteSamps = 10178
+Val_DigEdge = 10150
+Val_GroupByChannel = 0
+
+def noiseSource(npoints, samplefreq):
+    """ default input: low level noise on both channels """
+    return np.random.normal(0, 1e-4, (2, npoints))
+
+class StartleResponder:
+    """ synthetic startle responses (volts) to a stereo stimulus """
+    def __init__(self, amplitude=0.01, latency=10.0, jitter=1.0, frequency=150.0,
+                 decay=15.0, inhibition=0.5, variability=0.3, noise=5e-4,
+                 micgain=0.01, seed=None):
+        self.amplitude = amplitude # response size without a gap/prepulse
+        self.latency = latency # msec from startle onset
+        self.jitter = jitter # msec sd of the latency
+        self.frequency = frequency # Hz, of the damped oscillation
+        self.decay = decay # msec, time constant of the oscillation
+        self.inhibition = inhibition # response scale after a gap or prepulse
+        self.variability = variability # sd of log amplitude across trials
+        self.noise = noise
+        self.micgain = micgain
+        self.rng = np.random.RandomState(seed)
+
+    def source(self, wavel, waver, outfreq):
+        """ returns the data source for the RP2.1 for this stimulus """
+        return lambda npoints, samplefreq: self.response(wavel, waver, outfreq,
+                                                          npoints, samplefreq)
+
+    def startleOnset(self, waver):
+        """ index of the startle stimulus onset in the startle channel """
+        a = np.abs(waver)
+        if len(a) == 0 or np.max(a) == 0:
+            return None
+        return np.argmax(a > 0.1*np.max(a))
+
+    def isInhibited(self, wavel, onset, outfreq, window=150.0):
+        """ look for a gap (envelope drop) or a prepulse (envelope rise) in the
+            conditioning channel in the window before the startle onset """
+        block = 5.0 # msec
+        nb = int(block*outfreq/1000.0)
+        nblocks = onset // nb
+        if nblocks < 2:
+            return False
+        env = np.sqrt(np.mean(np.reshape(np.asarray(wavel[0:nblocks*nb])**2, (nblocks, nb)), axis=1))
+        level = np.median(env)
+        test = env[max(0, nblocks - int(window/block)):nblocks-1]
+        if level > 0 and np.min(test) < 0.25*level:
+            return True # gap
+        return np.max(test) > 3.0*level + 1e-9 # prepulse
+
+    def response(self, wavel, waver, outfreq, npoints, samplefreq):
+        t = np.arange(npoints)/float(samplefreq)
+        data = np.zeros((2, npoints))
+        data[0] = self.rng.normal(0, self.noise, npoints)
+        onset = self.startleOnset(waver)
+        if onset is not None:
+            amp = self.amplitude*np.exp(self.rng.normal(0, self.variability))
+            if self.isInhibited(wavel, onset, outfreq):
+                amp = amp*self.inhibition
+            lat = onset/float(outfreq) + (self.latency + self.rng.normal(0, self.jitter))/1000.0
+            tr = t - lat
+            resp = tr >= 0
+            data[0, resp] += amp*np.sin(2*np.pi*self.frequency*tr[resp])*np.exp(-tr[resp]*1000.0/self.decay)
+        tout = np.arange(len(waver))/float(outfreq) # microphone hears the stimulus
+        data[1] = self.micgain*np.interp(t, tout, np.asarray(wavel) + np.asarray(waver), right=0.0)
+        data[1] += self.rng.normal(0, self.noise, npoints)
+        return data
+
+class SimulatedRP21:
+    """ RP2.1 running startle2.rco: records two channels into Data_out1/2.
+        Soft trigger 1 starts a recording; soft trigger 2 resets the buffer
+        indices, which otherwise stay where they stopped (through Halt) until
+        the circuit is loaded again. """
+    START_TRIGGER = 1
+    RESET_TRIGGER = 2
+    samp_flist = [6103.5256125, 12210.703125, 24414.0625, 48828.125,
+                  97656.25, 195312.5]
+
+    def __init__(self, source=noiseSource, timescale=1.0):
+        self.source = source
+        self.timescale = timescale
+        self.sfreq = self.samp_flist[2]
+        self.tags = {'REC_Size': 0}
+        self.data = np.zeros((2, 0))
+        self.t0 = None
+        self.count = 0 # the buffer index while not recording
+        self.running = False
+        self.loads = 0 # circuits loaded
+
+    def ConnectRP2(self, interface, devnum):
+        return 1
+
+    def ClearCOF(self):
+        self.Halt()
+        self.count = 0
+        return 1
+
+    def LoadCOFsf(self, filename, sfflag):
+        self.sfreq = self.samp_flist[min(sfflag, 5)]
+        self.count = 0
+        self.loads += 1
+        return 1
+
+    def GetSFreq(self):
+        return self.sfreq
+
+    def SetTagVal(self, tag, value):
+        self.tags[tag] = value
+        return 1
+
+    def Run(self):
+        self.running = True
+        return 1
+
+    def SoftTrg(self, n):
+        if not self.running:
+            return 1 # not seen
+        if n == self.RESET_TRIGGER:
+            self.t0 = None # stops a recording in progress
+            self.count = 0
+            return 1
+        npts = int(self.tags['REC_Size'])
+        self.data = self.source(npts, self.sfreq)
+        self.t0 = time.time()
+        return 1
+
+    def Halt(self):
+        self.count = self.index()
+        self.running = False
+        self.t0 = None
+        return 1
+
+    def index(self):
+        if self.t0 is None:
+            return self.count
+        if self.timescale is None:
+            return self.data.shape[1]
+        n = int((time.time() - self.t0)*self.timescale*self.sfreq)
+        return min(n, self.data.shape[1])
+
+    def GetTagVal(self, tag):
+        if tag in ['Index1', 'Index2']:
+            return self.index()
+        return self.tags.get(tag, 0)
+
+    def ZeroTag(self, tag):
+        chan = {'Data_out1': 0, 'Data_out2': 1}[tag]
+        self.data[chan, :] = 0.0
+        return 1
+
+    def ReadTagV(self, tag, offset, npts):
+        chan = {'Data_out1': 0, 'Data_out2': 1}[tag]
+        return tuple(self.data[chan, int(offset):int(offset)+int(npts)])
+
+
+class SimulatedPA5:
+    def __init__(self):
+        self.atten = {1: 120.0, 2: 120.0}
+        self.current = 1
+
+    def ConnectPA5(self, interface, devnum):
+        self.current = devnum
+        return 1
+
+    def SetAtten(self, atten):
+        self.atten[self.current] = atten
+        return 1
+
+
+class SimulatedTask:
+    """ finite analog output task """
+    def __init__(self, timescale=1.0):
+        self.timescale = timescale
+        self.channels = []
+        self.rate = 100000.0
+        self.nsamps = 0
+        self.t0 = None
+        self.data = None
+
+    def CreateAOVoltageChan(self, chan, name, vmin, vmax, units, scale):
+        self.channels.append(chan)
+
+    def CfgSampClkTiming(self, source, rate, edge, mode, nsamps):
+        self.rate = float(rate)
+        self.nsamps = int(nsamps)
+
+    def SetStartTrigType(self, trigtype):
+        pass
+
+    def CfgDigEdgeStartTrig(self, source, edge):
+        pass
+
+    def write(self, data, timeout=10.):
+        self.data = data
+        return data.size/max(len(self.channels), 1)
+
+    def start(self):
+        self.t0 = time.time()
+
+    def stop(self):
+        self.t0 = None
+
+    def isTaskDone(self):
+        if self.t0 is None or self.timescale is None:
+            return True
+        return (time.time() - self.t0)*self.timescale >= self.nsamps/self.rate
+
+
+class SimulatedDevice:
+    def __init__(self, timescale=1.0):
+        self.timescale = timescale
+
+    def createTask(self, taskName=""):
+        return SimulatedTask(self.timescale)
+
+    def listAOChannels(self):
+        return ['Dev2/ao0', 'Dev2/ao1']
@@ -0,0 +1,280 @@
+"""
+StartleAnalysis.py - batch analysis of a startle session
+
+Takes the stacked (trials, samples) response matrix and, in one vectorized
+pass, filters the responses, extracts the analysis windows, computes the
+rejection statistics, the RMS startle magnitudes, d' and the gap ratio, and
+the gap/no-gap average waveforms. The result is returned as an
+AnalysisResult; the GUI only has to render it.
+
+During acquisition, OnlineDiscrimination keeps the same statistics up to
+date one trial at a time, in constant time per trial.
+"""
+# Paul B. Manis, Ph.D.
+# UNC Chapel Hill
+# Department of Otolaryngology/Head and Neck Surgery
+# Supported by NIH Grants DC000425-22 and DC004551-07 to PBM.
+#
+"""
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+from Utility import Utility
+import Windowing
+
+Utils = Utility()
+
+# reasons a trial is not included in the magnitudes
+REJECT_NONE = 0
+REJECT_ANNOTATION = 1
+REJECT_BASELINE = 2
+REJECT_SIGNAL_HIGH = 3
+REJECT_SIGNAL_LOW = 4
+REJECT_MESSAGES = {REJECT_ANNOTATION: "based on Behavior/Orientation/Location",
+                   REJECT_BASELINE: "baseline stdev is too big",
+                   REJECT_SIGNAL_HIGH: "signal stdev is too big",
+                   REJECT_SIGNAL_LOW: "signal stdev is too SMALL"}
+
+PROGRESS_BLOCK = 32 # trials filtered between progress reports
+
+
+class AnalysisResult(object):
+    """ Holds the results of analyzing one session. Per-trial arrays have one
+        entry per trial in the session; trials that were not analyzed (habituation,
+        truncated) have analyzed False and NaN statistics. """
+    def __init__(self):
+        self.filtered = None # (trials, samples) filtered responses
+        self.window = None # (trials, window points) filtered response after the startle
+        self.tb = None # window timebase, msec
+        self.analyzed = None # trials that were complete and past habituation
+        self.reject = None # REJECT_ code for each trial
+        self.accepted = None # analyzed and not rejected
+        self.gapmode = None
+        self.baselineStd = None
+        self.signalStd = None
+        self.avgBaseline = 0.0
+        self.avgSignal = 0.0
+        self.magnitude = None # RMS of the window, per trial
+        self.Gap_StartleMagnitude = np.array([])
+        self.noGap_StartleMagnitude = np.array([])
+        self.Gap_mean = 0.0
+        self.Gap_std = 0.0
+        self.noGap_mean = 0.0
+        self.noGap_std = 0.0
+        self.dprime = 0.0
+        self.ratio = 0.0
+        self.gapAverage = None # average response waveforms
+        self.noGapAverage = None
+        self.nGap = 0
+        self.nNoGap = 0
+
+    def rejectedTrials(self):
+        """ list of (trial, reason, value) for the rejected trials """
+        rej = []
+        for i in np.nonzero(self.reject != REJECT_NONE)[0]:
+            if self.reject[i] == REJECT_BASELINE:
+                value = self.baselineStd[i]
+            else:
+                value = self.signalStd[i]
+            rej.append((i, REJECT_MESSAGES[self.reject[i]], value))
+        return rej
+
+
+def analyzeSession(data, points, gapmode, delays, samplefreq,
+                   LPF=320.0, HPF=80.0, duration=150.0, rejectwindow=10.0,
+                   nhab=0, baselineStd=2.0, waveformStd=2.0, waveformMinStd=0.0,
+                   rejected=None, zerophase=False, filtered=None, progress=None):
+    """ Analyze a session.
+        data: (trials, samples) array of responses
+        points: number of valid samples in each trial
+        gapmode: boolean per trial, True for trials with a gap/prepulse
+        delays: delay to the startle for each trial (msec)
+        samplefreq: sample frequency (Hz)
+        LPF, HPF: filter corners (Hz)
+        duration: analysis window after the startle (msec)
+        rejectwindow: window after the startle used for the baseline rejection test (msec)
+        nhab: number of habituation trials (not analyzed)
+        baselineStd, waveformStd, waveformMinStd: rejection criteria, as multiples of
+            the average baseline and signal standard deviations
+        rejected: list of trials rejected from the annotation
+        zerophase: filter forward and backward, so the latencies are not shifted
+        filtered: data already filtered with these LPF, HPF and zerophase (the
+            filtered array of an earlier analysis of the same data); the
+            data are then not filtered again
+        progress: if given, called as progress(message) between the steps (the
+            filtering is then done a block of trials at a time); an exception
+            it raises (e.g., to cancel) stops the analysis
+    """
+    r = AnalysisResult()
+    data = np.atleast_2d(data)
+    ntrials = data.shape[0]
+    points = np.asarray(points)
+    gapmode = np.asarray(gapmode, dtype=bool)[0:ntrials]
+    r.gapmode = gapmode
+    srate = 1000.0/samplefreq # msec per point
+    stdur = int(duration/srate)
+    nrej = int(rejectwindow/srate)
+    nwin = max(stdur, nrej)
+
+    if filtered is not None:
+        r.filtered = filtered
+    elif progress is None:
+        r.filtered = Utils.SignalFilter(data, LPF, HPF, samplefreq, zerophase=zerophase) # all trials at once
+    else:
+        r.filtered = np.zeros(data.shape)
+        for i in range(0, ntrials, PROGRESS_BLOCK):
+            progress("Filtering trial %d of %d" % (i+1, ntrials))
+            r.filtered[i:i+PROGRESS_BLOCK] = Utils.SignalFilter(data[i:i+PROGRESS_BLOCK], LPF, HPF,
+                                                                samplefreq, zerophase=zerophase)
+    if progress is not None:
+        progress("Analyzing %d trials" % (ntrials))
+
+# analysis windows, gathered for all trials at once
+    ststart = Windowing.windowStarts(delays[0:ntrials], samplefreq)
+    complete = (ststart + nwin) <= points
+    if not np.all(complete): # only include trials up to the first truncated one
+        complete[np.argmin(complete):] = False
+    r.analyzed = complete & (np.arange(ntrials) >= nhab)
+    win = Windowing.gather(r.filtered, ststart, nwin)
+    r.window = win[:, 0:stdur]
+    r.tb = np.arange(0, stdur)*srate
+
+# rejection statistics
+    bl = np.std(win[:, 0:nrej], axis=1)
+    sig = np.std(r.window, axis=1)
+    if np.any(r.analyzed):
+        r.avgBaseline = np.mean(bl[r.analyzed])
+        r.avgSignal = np.mean(sig[r.analyzed])
+    r.reject = np.zeros(ntrials, dtype=int)
+    # assign in reverse order of precedence so the first failing test is reported
+    r.reject[sig < waveformMinStd*r.avgSignal] = REJECT_SIGNAL_LOW
+    r.reject[sig > waveformStd*r.avgSignal] = REJECT_SIGNAL_HIGH
+    r.reject[bl > baselineStd*r.avgBaseline] = REJECT_BASELINE
+    if rejected is not None and len(rejected) > 0:
+        rejected = np.asarray(rejected, dtype=int)
+        r.reject[rejected[rejected < ntrials]] = REJECT_ANNOTATION
+    r.reject[~r.analyzed] = REJECT_NONE
+    r.accepted = r.analyzed & (r.reject == REJECT_NONE)
+    r.baselineStd = np.where(r.analyzed, bl, np.nan)
+    r.signalStd = np.where(r.analyzed, sig, np.nan)
+
+# magnitudes, d' and the average waveforms
+    r.magnitude = np.where(r.analyzed, np.sqrt(np.mean(r.window**2.0, axis=1)), np.nan)
+    gap = r.accepted & gapmode
+    nogap = r.accepted & ~gapmode
+    r.Gap_StartleMagnitude = r.magnitude[gap]
+    r.noGap_StartleMagnitude = r.magnitude[nogap]
+    r.nGap = r.Gap_StartleMagnitude.shape[0]
+    r.nNoGap = r.noGap_StartleMagnitude.shape[0]
+    if r.nGap > 0:
+        r.Gap_mean = np.mean(r.Gap_StartleMagnitude)
+        r.Gap_std = np.std(r.Gap_StartleMagnitude)
+        r.gapAverage = np.mean(r.window[gap], axis=0)
+    else:
+        r.gapAverage = np.zeros(stdur)
+    if r.nNoGap > 0:
+        r.noGap_mean = np.mean(r.noGap_StartleMagnitude)
+        r.noGap_std = np.std(r.noGap_StartleMagnitude)
+        r.noGapAverage = np.mean(r.window[nogap], axis=0)
+    else:
+        r.noGapAverage = np.zeros(stdur)
+    if r.noGap_std != 0 and r.Gap_std != 0:
+        r.dprime = (r.noGap_mean - r.Gap_mean)/np.sqrt(r.noGap_std**2 + r.Gap_std**2)
+        r.ratio = r.Gap_mean/r.noGap_mean
+    return r
+
+
+class RunningStats(object):
+    """ mean and standard deviation of a stream of values, updated in O(1) per
+        value (Welford's method). std is the population value, as np.std. """
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0 # sum of squared deviations from the mean
+
+    def add(self, x):
+        self.n += 1
+        d = x - self.mean
+        self.mean += d/self.n
+        self.m2 += d*(x - self.mean)
+
+    def var(self):
+        if self.n == 0:
+            return 0.0
+        return self.m2/self.n
+
+    def std(self):
+        return np.sqrt(self.var())
+
+    def ci(self, z=1.96):
+        """ normal approximation confidence interval for the mean """
+        if self.n < 2:
+            return (np.nan, np.nan)
+        h = z*np.sqrt(self.m2/(self.n - 1)/self.n)
+        return (self.mean - h, self.mean + h)
+
+
+class OnlineDiscrimination(object):
+    """ gap/no-gap startle magnitudes as they are acquired: the magnitudes are
+        kept in preallocated arrays (for ntrials, grown if needed), and the
+        means, standard deviations, d' and the gap ratio are updated in O(1)
+        per trial. """
+    def __init__(self, ntrials=0):
+        n = max(int(ntrials), 1)
+        self.values = {True: np.zeros(n), False: np.zeros(n)}
+        self.stats = {True: RunningStats(), False: RunningStats()}
+
+    def add(self, magnitude, gap):
+        gap = bool(gap)
+        st = self.stats[gap]
+        v = self.values[gap]
+        if st.n >= len(v):
+            v = self.values[gap] = np.concatenate((v, np.zeros(len(v))))
+        v[st.n] = magnitude
+        st.add(magnitude)
+
+    def magnitudes(self, gap):
+        """ the magnitudes so far for the condition (a view) """
+        return self.values[bool(gap)][0:self.stats[bool(gap)].n]
+
+    def dprime(self):
+        g = self.stats[True]
+        ng = self.stats[False]
+        if g.std() == 0 or ng.std() == 0:
+            return 0.0
+        return (ng.mean - g.mean)/np.sqrt(ng.var() + g.var())
+
+    def ratio(self):
+        if self.stats[True].std() == 0 or self.stats[False].std() == 0:
+            return 0.0
+        return self.stats[True].mean/self.stats[False].mean
+
+    def dprimeCI(self, z=1.96):
+        """ approximate confidence interval for d'. The standard error is
+            that of this d' (the difference of the means over the root of the sum
+            of the variances), from the two variances: the error of the
+            difference, and (delta method) of the sum of the variances. """
+        g = self.stats[True]
+        ng = self.stats[False]
+        if g.n < 2 or ng.n < 2:
+            return (np.nan, np.nan)
+        (v1, v2) = (g.var(), ng.var())
+        s2 = v1 + v2
+        if s2 == 0:
+            return (np.nan, np.nan)
+        d = self.dprime()
+        se2 = (v1/g.n + v2/ng.n)/s2 + d**2*(v1**2/(g.n - 1) + v2**2/(ng.n - 1))/(2.0*s2**2)
+        h = z*np.sqrt(se2)
+        return (d - h, d + h)
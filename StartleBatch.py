@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""
+StartleBatch.py - re-analyze many sessions from the command line
+
+Finds the startle sessions (binary session files, and old text files that
+have not been converted) under one or more directories, and runs the same
+analysis as the GUI's Analyze_Data on each (filter, rejection, RMS magnitudes,
+d' and the gap ratio) in a pool of processes, one session per task. Each
+process reads its own (memory-mapped) file and returns one summary row, so the
+work scales with the number of cores. One tab-separated summary table, with
+one row per session, is written for each cohort: the first directory level
+below each root (or the root itself, for sessions directly in it). The table
+is written in the cohort's root, so cohorts of the same name under different
+roots are kept apart; names that would still share a table (a subdirectory
+named as its root, or the same cohort under two roots with -o) are an error.
+
+usage: python StartleBatch.py [options] directory [directory ...]
+    python StartleBatch.py -h lists the options (the defaults are those of
+    the analysis tab). Trial rejections made in the annotation table are not
+    applied.
+"""
+# Paul B. Manis, Ph.D.
+# UNC Chapel Hill
+# Department of Otolaryngology/Head and Neck Surgery
+# Supported by NIH Grants DC000425-22 and DC004551-07 to PBM.
+#
+"""
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys, os, fnmatch, time
+import csv
+import multiprocessing
+from optparse import OptionParser
+import numpy as np
+import StartleData
+import StartleAnalysis
+
+# analysis settings, as the defaults of the analysis tab in PyStartle3
+DEFAULT_OPTIONS = {'LPF': 320.0, 'HPF': 80.0, 'duration': 100.0, 'rejectwindow': 10.0,
+                   'baselineStd': 2.0, 'waveformStd': 3.0, 'waveformMinStd': 0.2,
+                   'zerophase': False}
+
+COLUMNS = ['cohort', 'session', 'file', 'ntrials', 'nhab', 'analyzed', 'rejected',
+           'nGap', 'nNoGap', 'Gap_mean', 'Gap_std', 'noGap_mean', 'noGap_std',
+           'dprime', 'ratio', 'error']
+
+SUMMARY_SUFFIX = '_summary.txt'
+
+def findSessions(root, pattern='*_Startle*'):
+    """ the session files under root, as (cohort, filename). Text files that
+        have been converted to session files are only listed once. """
+    found = []
+    root = os.path.abspath(root)
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        dirnames.sort()
+        rel = os.path.relpath(dirpath, root)
+        if rel == os.curdir:
+            cohort = os.path.basename(root)
+        else:
+            cohort = rel.split(os.sep)[0]
+        names = set(filenames)
+        for f in sorted(filenames):
+            if not fnmatch.fnmatch(f, pattern):
+                continue
+            (base, ext) = os.path.splitext(f)
+            if ext == StartleData.FILE_EXTENSION:
+                found.append((cohort, os.path.join(dirpath, f)))
+            elif ext == '.txt' and base + StartleData.FILE_EXTENSION not in names:
+                found.append((cohort, os.path.join(dirpath, f)))
+    return found
+
+def analyzeFile(task):
+    """ analyze one session; runs in a worker process. Returns the summary row
+        (with the error, rather than raising, if the file could not be analyzed). """
+    (cohort, filename, options) = task
+    row = dict([(c, '') for c in COLUMNS])
+    row['cohort'] = cohort
+    row['file'] = filename
+    row['session'] = os.path.splitext(os.path.basename(filename))[0]
+    try:
+        s = StartleData.loadSession(filename, mmap=True)
+        p = s.params
+        delays = s.records['cndur'] + p['PP_Dur'] + p['PS_Dur']
+        nhab = int(p['NHabTrials'])
+        r = StartleAnalysis.analyzeSession(s.ch1(), s.points(), s.gapmode(), delays,
+                                           s.samplefreq, nhab=nhab, **options)
+    except Exception, e:
+        row['error'] = "%s: %s" % (type(e).__name__, e)
+        return row
+    row.update({'ntrials': len(s), 'nhab': nhab, 'analyzed': int(np.sum(r.analyzed)),
+                'rejected': int(np.sum(r.analyzed & ~r.accepted)),
+                'nGap': r.nGap, 'nNoGap': r.nNoGap,
+                'Gap_mean': r.Gap_mean, 'Gap_std': r.Gap_std,
+                'noGap_mean': r.noGap_mean, 'noGap_std': r.noGap_std,
+                'dprime': r.dprime, 'ratio': r.ratio})
+    return row
+
+def writeSummary(filename, rows):
+    fh = open(filename, 'wb')
+    try:
+        w = csv.DictWriter(fh, COLUMNS, delimiter='\t', lineterminator='\n')
+        w.writeheader()
+        for row in sorted(rows, key=lambda r: r['file']):
+            w.writerow(row)
+    finally:
+        fh.close()
+
+def planBatch(roots, options=DEFAULT_OPTIONS, outdir=None):
+    """ the sessions under the roots, and the summary table for each cohort:
+        returns (tasks, {(root, cohort): table}, {filename: (root, cohort)}).
+        Raises ValueError if two cohorts would be written to the same table. """
+    tasks = []
+    tables = {}
+    keys = {}
+    owner = {} # table -> (root, cohort, cohort directory)
+    for root in roots:
+        root = os.path.abspath(root)
+        for (cohort, filename) in findSessions(root):
+            key = (root, cohort)
+            cdir = os.path.relpath(os.path.dirname(filename), root).split(os.sep)[0]
+            table = os.path.join(outdir or root, cohort + SUMMARY_SUFFIX)
+            o = owner.setdefault(table, (root, cohort, cdir))
+            if o != (root, cohort, cdir):
+                raise ValueError("cohorts %s and %s would both be written to %s" % (
+                                 os.path.normpath(os.path.join(o[0], o[2])),
+                                 os.path.normpath(os.path.join(root, cdir)), table))
+            tables[key] = table
+            keys[filename] = key
+            tasks.append((cohort, filename, options))
+    return (tasks, tables, keys)
+
+def runBatch(roots, options=DEFAULT_OPTIONS, processes=None, outdir=None, verbose=True):
+    """ analyze all the sessions under the roots; returns {(root, cohort): rows}.
+        The tables are written to outdir (default: each root directory). """
+    (tasks, tables, keys) = planBatch(roots, options, outdir)
+    # the largest files first, so that no process is left with a long one at the end
+    tasks.sort(key=lambda t: -os.path.getsize(t[1]))
+    results = {}
+    if len(tasks) == 0:
+        return results
+    pool = multiprocessing.Pool(processes)
+    try:
+        for (i, row) in enumerate(pool.imap_unordered(analyzeFile, tasks, chunksize=1)):
+            results.setdefault(keys[row['file']], []).append(row)
+            if verbose:
+                status = row['error'] or ("d' = %.3f" % (row['dprime']))
+                print "[%d/%d] %s: %s" % (i+1, len(tasks), row['file'], status)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    for (key, rows) in results.items():
+        writeSummary(tables[key], rows)
+    return results
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options] directory [directory ...]")
+    d = DEFAULT_OPTIONS
+    parser.add_option('-j', '--processes', type='int', default=None,
+                      help="number of worker processes (default: one per core)")
+    parser.add_option('-o', '--outdir', default=None,
+                      help="directory for the summary tables (default: each root)")
+    parser.add_option('--lpf', type='float', default=d['LPF'], help="low pass corner, Hz")
+    parser.add_option('--hpf', type='float', default=d['HPF'], help="high pass corner, Hz")
+    parser.add_option('--duration', type='float', default=d['duration'],
+                      help="analysis window after the startle, msec")
+    parser.add_option('--rejectwindow', type='float', default=d['rejectwindow'],
+                      help="baseline rejection window, msec")
+    parser.add_option('--baselinestd', type='float', default=d['baselineStd'])
+    parser.add_option('--waveformstd', type='float', default=d['waveformStd'])
+    parser.add_option('--waveformminstd', type='float', default=d['waveformMinStd'])
+    parser.add_option('--zerophase', action='store_true', default=d['zerophase'],
+                      help="filter forward and backward (no latency shift)")
+    (opts, args) = parser.parse_args()
+    if len(args) == 0:
+        parser.error("no directories given")
+    options = {'LPF': opts.lpf, 'HPF': opts.hpf, 'duration': opts.duration,
+               'rejectwindow': opts.rejectwindow, 'baselineStd': opts.baselinestd,
+               'waveformStd': opts.waveformstd, 'waveformMinStd': opts.waveformminstd,
+               'zerophase': opts.zerophase}
+    t0 = time.time()
+    try:
+        results = runBatch(args, options, opts.processes, opts.outdir)
+    except ValueError, e:
+        parser.error(str(e))
+    nfiles = sum([len(rows) for rows in results.values()])
+    print "%d sessions in %d cohorts, %.1f s" % (nfiles, len(results), time.time() - t0)
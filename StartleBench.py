@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+StartleBench.py - headless end-to-end benchmark of the trial loop
+
+Runs a gap-startle session on the simulated hardware backend: stimulus
+synthesis, presentation/acquisition and the batch analysis, with the time
+spent in each phase reported per trial. Use it to catch throughput
+regressions in the trial loop without a sound booth. It fails if the RP2.1
+circuit is loaded more than once in the run, or if the response filtered as
+it is acquired differs from the whole trace filtered at once.
+
+usage: python StartleBench.py [ntrials [timescale]]
+    timescale speeds up the simulated hardware clock (default: no waiting)
+"""
+# Paul B. Manis, Ph.D.
+# UNC Chapel Hill
+# Department of Otolaryngology/Head and Neck Surgery
+# Supported by NIH Grants DC000425-22 and DC004551-07 to PBM.
+#
+"""
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys, time
+import numpy as np
+import scipy.signal
+import PySounds
+import Hardware
+import StartleAnalysis
+import StimulusGraph
+from Utility import StreamingFilter, filterCache
+
+# a gap-startle protocol, as in Protocols/GapStartle.ini (conditioning shortened)
+DEFAULT_PARAMS = {'CN_Level': 70.0, 'CN_Dur': 500.0, 'PP_Dur': 50.0, 'PS_Dur': 50.0,
+                  'PP_HP': 8000.0, 'PP_LP': 16000.0, 'ST_Dur': 50.0, 'ST_Level': 80.0,
+                  'PostDuration': 0.35, 'NHabTrials': 2, 'NoiseMethod': 'fft'}
+
+def runBench(ntrials=24, timescale=None, params=DEFAULT_PARAMS, seed=1):
+    Sounds = PySounds.PySounds(simulate=True)
+    backend = Hardware.SimulatedBackend(timescale=timescale, seed=seed)
+    backend.open()
+    Sounds.setBackend(backend)
+    Sounds.startSession()
+    sos = filterCache.bandpass(320.0, 80.0, Sounds.in_sampleFreq)
+    Sounds.setInputFilter(0, StreamingFilter(sos))
+    Sounds.noise.reseed(seed)
+    p = params
+    sf = Sounds.out_sampleFreq
+    nhab = p['NHabTrials']
+    gaplist = nhab*[False] + (ntrials//2)*[False, True]
+    ntotal = len(gaplist)
+    tsynth = np.zeros(ntotal)
+    tplay = np.zeros(ntotal)
+    responses = []
+    total = p['CN_Dur']+p['PP_Dur']+p['PS_Dur']+p['ST_Dur']
+    G = StimulusGraph
+    cn = G.Level(G.Noise((p['PP_HP'], p['PP_LP']), total, method=p['NoiseMethod']), p['CN_Level'])
+    st = G.Level(G.Noise((1000.0, 32000.0), p['ST_Dur'], method=p['NoiseMethod']), p['ST_Level'], channel=1)
+    plan = G.compileGraph([G.Gap(cn, delay=p['CN_Dur'], duration=p['PP_Dur'], cut=G.Param('gap')),
+                           G.Sum([st], [p['CN_Dur']+p['PP_Dur']+p['PS_Dur']])], Sounds, sf, total)
+    for trial in range(0, ntotal):
+        t0 = time.time()
+        Sounds.noise.setTrial(trial)
+        (wL, wR) = plan.render({'gap': gaplist[trial]})
+        t1 = time.time()
+        Sounds.playSound(wL, wR, sf, p['PostDuration'])
+        (ch1, ch2) = Sounds.retrieveInputs()
+        if not np.allclose(Sounds.retrieveFiltered(0), scipy.signal.sosfilt(sos, ch1),
+                           rtol=1e-4, atol=1e-6):
+            raise AssertionError("trial %d: streaming filter differs from sosfilt" % (trial))
+        responses.append(1000.0*np.array(ch1)) # mV, as stored in the data files
+        t2 = time.time()
+        tsynth[trial] = t1 - t0
+        tplay[trial] = t2 - t1
+    Sounds.endSession()
+    # the circuit is loaded once, at open; the trials of a run only reset it
+    if backend.RP21.loads != 1:
+        raise AssertionError("startle2.rco loaded %d times in a run of %d trials" % (
+                             backend.RP21.loads, ntotal))
+    npts = max([len(r) for r in responses])
+    data = np.zeros((ntotal, npts), dtype='float32')
+    for (i, r) in enumerate(responses):
+        data[i, 0:len(r)] = r
+    points = [len(r) for r in responses]
+    delays = ntotal*[p['CN_Dur']+p['PP_Dur']+p['PS_Dur']]
+    t0 = time.time()
+    result = StartleAnalysis.analyzeSession(data, points, gaplist, delays, Sounds.in_sampleFreq,
+                                            nhab=nhab, duration=100.0)
+    tanalysis = time.time() - t0
+    return (tsynth, tplay, tanalysis, result)
+
+if __name__ == "__main__":
+    ntrials = 24
+    timescale = None
+    if len(sys.argv) > 1:
+        ntrials = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        timescale = float(sys.argv[2])
+    (tsynth, tplay, tanalysis, r) = runBench(ntrials, timescale)
+    print "Trials: %d" % (len(tsynth))
+    print "Synthesis:  mean %8.2f ms  max %8.2f ms" % (1000*np.mean(tsynth), 1000*np.max(tsynth))
+    print "Play/acq:   mean %8.2f ms  max %8.2f ms" % (1000*np.mean(tplay), 1000*np.max(tplay))
+    print "Analysis:   %8.2f ms" % (1000*tanalysis)
+    print "Gap: %f +/- %f  No Gap: %f +/- %f  d' = %f  ratio = %f" % (r.Gap_mean, r.Gap_std,
+                                     r.noGap_mean, r.noGap_std, r.dprime, r.ratio)
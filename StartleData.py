@@ -0,0 +1,306 @@
+"""
+StartleData.py - binary storage for startle sessions
+
+A session file holds a fixed header block followed by fixed-layout trial
+records, so that trials can be appended while acquiring and the whole
+session can be loaded back as a single numpy array, or memory-mapped so
+that the trials are views onto the file rather than copies.
+
+File layout (all little-endian):
+    prefix:  magic (8s), version (H), nchannels (H), header length (I),
+             points per record (I), input sample frequency (d)
+    header:  repr() of a dictionary holding the parameter dict ('Params')
+             and the gap list ('GapList'), padded to a 16 byte boundary
+    records: one per trial, RECORD_META fields followed by
+             float32[nchannels, points] response data (mV)
+
+Trials shorter than the record length are zero padded; the number of valid
+points is kept in the 'points' field of each record. The timebase is not
+stored - it is computed from the sample frequency.
+
+Older *_Startle.txt files are read with readTextSession, and can be
+converted to the binary format with convertTextSession.
+"""
+# Paul B. Manis, Ph.D.
+# UNC Chapel Hill
+# Department of Otolaryngology/Head and Neck Surgery
+# Supported by NIH Grants DC000425-22 and DC004551-07 to PBM.
+#
+"""
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os, struct, ast
+import time
+import numpy as np
+
+MAGIC_NUMBER = 'PYSTRTLE'
+FILE_VERSION = 1
+FILE_EXTENSION = '.stb'
+PREFIX_FORMAT = '<8sHHIId'
+PREFIX_SIZE = struct.calcsize(PREFIX_FORMAT)
+ALIGNMENT = 16
+
+# per-trial metadata table entries, stored at the start of each record
+RECORD_META = [('trial', '<i4'), ('points', '<i4'), ('gap', '<i4'),
+               ('iti', '<f8'), ('cndur', '<f8'), ('outSampleFreq', '<f8'),
+               ('timestamp', '<f8')]
+
+class StartleDataError(Exception):
+    pass
+
+def recordDtype(npoints, nchannels=2):
+    """ numpy dtype of one trial record """
+    return np.dtype(RECORD_META + [('data', '<f4', (nchannels, npoints))])
+
+def sessionFileName(filename):
+    """ change the extension of a (text) data file name to the binary one """
+    (fb, e) = os.path.splitext(filename)
+    return fb + FILE_EXTENSION
+
+def isSessionFile(filename):
+    """ check the magic number at the start of the file """
+    try:
+        fh = open(filename, 'rb')
+    except IOError:
+        return False
+    magic = fh.read(len(MAGIC_NUMBER))
+    fh.close()
+    return magic == MAGIC_NUMBER
+
+
+class Session(object):
+    """ An acquired session: the parameters, gap list and trial records.
+        records is a structured array with one entry per trial; the channel
+        data are exposed as (n_trials, n_points) arrays. """
+    def __init__(self, params, gaplist, samplefreq, records, filename=None):
+        self.params = params
+        self.gaplist = gaplist
+        self.samplefreq = float(samplefreq)
+        self.records = records
+        self.filename = filename
+
+    def __len__(self):
+        return self.records.shape[0]
+
+    def ntrials(self):
+        return self.records.shape[0]
+
+    def npoints(self):
+        return self.records.dtype['data'].shape[1]
+
+    def channel(self, chan):
+        return self.records['data'][:, chan, :]
+
+    def ch1(self):
+        return self.channel(0)
+
+    def ch2(self):
+        return self.channel(1)
+
+    def points(self):
+        return self.records['points']
+
+    def gapmode(self):
+        return self.records['gap'].astype(bool)
+
+    def timebase(self):
+        """ time (seconds) of each point in a record """
+        return np.arange(self.npoints())/self.samplefreq
+
+
+class SessionWriter(object):
+    """ Write a session file. The header is written when the file is created;
+        each call to append adds one trial record and flushes it to disk, so
+        the file can be read while acquisition is still running. """
+    def __init__(self, filename, params, gaplist, npoints, samplefreq, nchannels=2):
+        self.filename = filename
+        self.npoints = int(npoints)
+        self.nchannels = int(nchannels)
+        self.dtype = recordDtype(self.npoints, self.nchannels)
+        self.record = np.zeros(1, dtype=self.dtype) # reused for every trial
+        self.ntrials = 0
+        header = repr({'Params': params, 'GapList': list(gaplist)})
+        pad = (ALIGNMENT - (PREFIX_SIZE + len(header)) % ALIGNMENT) % ALIGNMENT
+        header = header + ' '*pad
+        self.fh = open(filename, 'wb')
+        self.fh.write(struct.pack(PREFIX_FORMAT, MAGIC_NUMBER, FILE_VERSION,
+                                  self.nchannels, len(header), self.npoints,
+                                  float(samplefreq)))
+        self.fh.write(header)
+        self.fh.flush()
+
+    def append(self, channels, gap=False, iti=0.0, cndur=0.0, outsamplefreq=0.0):
+        """ channels is a sequence of nchannels traces (mV). Traces longer than
+            the record length are truncated. """
+        if self.fh is None:
+            raise StartleDataError("SessionWriter: file %s is closed" % (self.filename))
+        rec = self.record
+        rec['data'] = 0.0
+        npts = self.npoints
+        for i in range(0, self.nchannels):
+            n = min(len(channels[i]), self.npoints)
+            rec['data'][0, i, 0:n] = channels[i][0:n]
+            npts = min(npts, n)
+        rec['trial'] = self.ntrials
+        rec['points'] = npts
+        rec['gap'] = int(gap)
+        rec['iti'] = iti
+        rec['cndur'] = cndur
+        rec['outSampleFreq'] = outsamplefreq
+        rec['timestamp'] = time.time()
+        rec.tofile(self.fh)
+        self.fh.flush()
+        self.ntrials += 1
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+    def __del__(self):
+        self.close()
+
+
+def readSessionHeader(filename):
+    """ read the header block. Returns (params, gaplist, samplefreq, dtype, offset) """
+    fh = open(filename, 'rb')
+    try:
+        prefix = fh.read(PREFIX_SIZE)
+        if len(prefix) < PREFIX_SIZE:
+            raise StartleDataError("%s is too short to be a session file" % (filename))
+        (magic, version, nchannels, hlen, npoints, samplefreq) = struct.unpack(PREFIX_FORMAT, prefix)
+        if magic != MAGIC_NUMBER:
+            raise StartleDataError("%s is not a startle session file" % (filename))
+        if version > FILE_VERSION:
+            raise StartleDataError("%s: file version %d is newer than this reader (%d)" %
+                                   (filename, version, FILE_VERSION))
+        header = ast.literal_eval(fh.read(hlen).strip())
+    finally:
+        fh.close()
+    return (header['Params'], header['GapList'], samplefreq,
+            recordDtype(npoints, nchannels), PREFIX_SIZE + hlen)
+
+def readSession(filename, mmap=False):
+    """ load a whole session file as a single structured array.
+        With mmap=True, the records are memory-mapped (read only) instead, and
+        the channel arrays of the Session are zero-copy views of the file.
+        A partially written record at the end of the file (acquisition still
+        running, or interrupted) is ignored. """
+    (params, gaplist, samplefreq, dtype, offset) = readSessionHeader(filename)
+    ntrials = (os.path.getsize(filename) - offset) // dtype.itemsize
+    if mmap and ntrials > 0:
+        records = np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                            shape=(ntrials,))
+    else:
+        fh = open(filename, 'rb')
+        try:
+            fh.seek(offset)
+            records = np.fromfile(fh, dtype=dtype, count=ntrials)
+        finally:
+            fh.close()
+    return Session(params, gaplist, samplefreq, records, filename=filename)
+
+################################################################################
+# text (*_Startle.txt) files
+#
+# line 1 is the parameter dictionary, line 2 holds the gap list dictionary.
+# each trial then has a dictionary line with 'Points' and the sample rate,
+# followed by 'Points' lines of "t ch1 ch2".
+################################################################################
+
+def _evalDict(line):
+    try:
+        return ast.literal_eval(line.strip())
+    except (ValueError, SyntaxError):
+        # very long or odd lines; break them down the way Utility.long_Eval does
+        u = {}
+        for di in line.split(','):
+            try:
+                r = ast.literal_eval('{' + di.strip().strip('{}') + '}')
+                u.update(r)
+            except (ValueError, SyntaxError):
+                continue
+        return u
+
+def readTextSession(filename):
+    """ read an old style text data file into a Session """
+    hstat = open(filename, 'r')
+    try:
+        params = _evalDict(hstat.readline())
+        gaplist = _evalDict(hstat.readline()).get('GapList', [])
+        trials = []
+        line = hstat.readline()
+        while line:
+            info = _evalDict(line)
+            npts = int(info['Points'])
+            lines = []
+            for i in range(0, npts):
+                line = hstat.readline()
+                if not line:
+                    break
+                lines.append(line)
+            d = np.fromstring(''.join(lines), sep=' ')
+            d = d[0:3*(len(d)//3)].reshape((-1, 3))
+            trials.append((info, d))
+            line = hstat.readline()
+    finally:
+        hstat.close()
+    if len(trials) == 0:
+        raise StartleDataError("%s: no trials found" % (filename))
+    info = trials[0][0]
+    if 'SampleRate' in info:
+        samplefreq = float(info['SampleRate'])
+    elif 'inSampleFreq' in info:
+        samplefreq = float(info['inSampleFreq'])
+    else:
+        samplefreq = 1.0/(trials[0][1][1, 0] - trials[0][1][0, 0]) # from the timebase
+    npoints = max([int(tr[0]['Points']) for tr in trials])
+    records = np.zeros(len(trials), dtype=recordDtype(npoints, 2))
+    for i, (info, d) in enumerate(trials):
+        n = d.shape[0]
+        records['trial'][i] = i
+        records['points'][i] = n
+        records['gap'][i] = int(info.get('GapMode', False))
+        records['iti'][i] = info.get('ITI', 0.0)
+        records['cndur'][i] = info.get('CNDur', 0.0)
+        records['outSampleFreq'][i] = info.get('outSampleFreq', 0.0)
+        records['data'][i, 0, 0:n] = d[:, 1]
+        records['data'][i, 1, 0:n] = d[:, 2]
+    return Session(params, gaplist, samplefreq, records, filename=filename)
+
+def convertTextSession(filename, outfile=None):
+    """ convert an old style text data file to a binary session file.
+        Returns the name of the new file. """
+    s = readTextSession(filename)
+    if outfile is None:
+        outfile = sessionFileName(filename)
+    w = SessionWriter(outfile, s.params, s.gaplist, s.npoints(), s.samplefreq)
+    for rec in s.records:
+        w.append(rec['data'][:, 0:rec['points']], gap=rec['gap'], iti=rec['iti'], cndur=rec['cndur'],
+                 outsamplefreq=rec['outSampleFreq'])
+    w.close()
+    return outfile
+
+def loadSession(filename, mmap=False):
+    """ load either a binary session file or an old style text file.
+        mmap applies to binary files only; text files are always read into memory. """
+    if isSessionFile(filename):
+        return readSession(filename, mmap=mmap)
+    return readTextSession(filename)
+
+if __name__ == "__main__":
+    import sys
+    for f in sys.argv[1:]:
+        print "%s -> %s" % (f, convertTextSession(f))
@@ -0,0 +1,92 @@
+"""
+StimulusBank.py - precomputed stimuli for a run
+
+The bank holds one stereo waveform per trial in a preallocated float32 array.
+It is filled when the run starts (optionally by a background thread), so that
+presenting a trial is a lookup rather than a synthesis inside the trial timer.
+"""
+# Paul B. Manis, Ph.D.
+# UNC Chapel Hill
+# Department of Otolaryngology/Head and Neck Surgery
+# Supported by NIH Grants DC000425-22 and DC004551-07 to PBM.
+#
+"""
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import numpy as np
+
+class StimulusBank(object):
+    """ Stimuli for ntrials trials of up to maxpoints points on nchannels channels.
+        maker is called as maker(trial) and returns one waveform per channel. """
+    def __init__(self, ntrials, maxpoints, maker, nchannels=2):
+        self.ntrials = ntrials
+        self.maker = maker
+        self.waves = np.zeros((ntrials, nchannels, maxpoints), dtype='float32')
+        self.lengths = np.zeros(ntrials, dtype=int)
+        self.ready = [threading.Event() for i in range(0, ntrials)]
+        self.lock = threading.Lock() # only one synthesis at a time
+        self.worker = None
+        self.abort = False
+
+    def nbytes(self):
+        return self.waves.nbytes
+
+    def build(self, background=False):
+        """ fill the bank. In the background, trials are made in order, so the
+            first trials are available almost immediately. """
+        self.abort = False
+        if background:
+            self.worker = threading.Thread(target=self._fill, name='StimulusBank')
+            self.worker.daemon = True
+            self.worker.start()
+        else:
+            self._fill()
+
+    def _fill(self):
+        for trial in range(0, self.ntrials):
+            if self.abort:
+                return
+            self.make(trial)
+
+    def make(self, trial):
+        with self.lock:
+            if self.ready[trial].isSet():
+                return
+            waves = self.maker(trial)
+            n = min(max([len(w) for w in waves]), self.waves.shape[2])
+            for (i, w) in enumerate(waves):
+                m = min(len(w), n)
+                self.waves[trial, i, 0:m] = w[0:m]
+            self.lengths[trial] = n
+            self.ready[trial].set()
+
+    def get(self, trial):
+        """ return views of the waveforms for this trial (all the same length).
+            If the trial has not been made yet and no worker is running, it is made now. """
+        if not self.ready[trial].isSet():
+            if self.worker is not None and self.worker.isAlive():
+                self.ready[trial].wait()
+            else:
+                self.make(trial)
+        n = self.lengths[trial]
+        return [self.waves[trial, i, 0:n] for i in range(0, self.waves.shape[1])]
+
+    def stop(self):
+        """ stop a background build """
+        self.abort = True
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
@@ -0,0 +1,296 @@
+"""
+StimulusGraph.py - declarative multi-channel stimuli
+
+A stimulus is described once per session as a graph: sources (Tone, Noise,
+Silence), Level (scaling to dB SPL), Gap (a shaped gap cut into its input) and
+Sum (inputs added at delays), with one graph per output channel. Anything that
+changes from trial to trial (the conditioning duration, whether this is a gap
+trial) is a Param, looked up in the values given for each trial.
+
+compileGraph() turns the graph into a RenderPlan: identical subgraphs are merged,
+so a shared node (e.g., the conditioning background) is made once per trial,
+and Level, Sum and Gap are folded into the additions and gaps of one
+Compositor buffer, so all the channels are rendered in one pass with no
+intermediate waveforms. Sources that do not depend on the noise are kept
+from trial to trial. Times are in msec, as for StimulusMaker.
+"""
+# Paul B. Manis, Ph.D.
+# UNC Chapel Hill
+# Department of Otolaryngology/Head and Neck Surgery
+# Supported by NIH Grants DC000425-22 and DC004551-07 to PBM.
+#
+"""
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import abc
+import numpy as np
+import PySounds
+
+class Param(object):
+    """ a value taken, by name, from the values for the trial """
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "Param(%r)" % (self.name)
+
+def resolve(value, values):
+    if isinstance(value, Param):
+        return values[value.name]
+    if isinstance(value, (list, tuple)):
+        return tuple([resolve(v, values) for v in value])
+    return value
+
+def frozen(value):
+    """ a hashable form of a parameter value """
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple([frozen(v) for v in value])
+    if isinstance(value, Param):
+        return repr(value)
+    return value
+
+
+class Node(object):
+    """ enable=False (or a Param that is False) removes the node from the trial """
+    __metaclass__ = abc.ABCMeta
+    static = False # the waveform depends only on the parameters (no noise)
+    silent = False # the waveform is all zeros
+
+    def __init__(self, inputs=(), enable=True, **params):
+        self.inputs = list(inputs)
+        self.params = params
+        self.params['enable'] = enable
+
+    def get(self, name, values):
+        return resolve(self.params[name], values)
+
+    def signature(self):
+        """ the node's type and parameters (its inputs are compared separately) """
+        return (type(self).__name__,
+                tuple(sorted([(k, frozen(v)) for (k, v) in self.params.items()])))
+
+    def key(self, values):
+        """ the resolved parameters, for keeping static waveforms between trials """
+        return (type(self).__name__,
+                tuple(sorted([(k, frozen(resolve(v, values))) for (k, v) in self.params.items()])))
+
+    def duration(self, values):
+        return self.get('duration', values)
+
+    @abc.abstractmethod
+    def make(self, plan, values, inputs):
+        """ the waveform, from the waveforms of the inputs """
+
+
+class Source(Node):
+    def __init__(self, mode, freq, duration, rf=2.5, method='iir', enable=True):
+        Node.__init__(self, (), enable, mode=mode, freq=freq, duration=duration, rf=rf,
+                      method=method)
+
+    def make(self, plan, values, inputs):
+        return plan.sounds.StimulusMaker(mode=self.get('mode', values), freq=self.get('freq', values),
+                                         duration=self.get('duration', values),
+                                         rf=self.get('rf', values), samplefreq=plan.samplefreq,
+                                         delay=0, level=None, method=self.get('method', values))
+
+class Tone(Source):
+    """ freq is a tone (and a 0 placeholder), or a list of tones with multi=True """
+    static = True
+    def __init__(self, freq, duration, rf=2.5, multi=False, enable=True):
+        mode = 'tone'
+        if multi:
+            mode = 'multitones'
+        Source.__init__(self, mode, freq, duration, rf, enable=enable)
+
+class Noise(Source):
+    """ mode is 'bbnoise', 'bpnoise' (freq = (HP, LP)) or 'notchnoise' (HP, LP, notch F1, F2) """
+    def __init__(self, freq, duration, rf=2.5, mode='bpnoise', method='iir', enable=True):
+        Source.__init__(self, mode, freq, duration, rf, method, enable)
+
+class Silence(Node):
+    static = True
+    silent = True
+    def __init__(self, duration, enable=True):
+        Node.__init__(self, (), enable, duration=duration)
+
+    def make(self, plan, values, inputs):
+        return np.zeros(plan.npoints(self.duration(values)))
+
+
+class Level(Node):
+    """ scale a waveform normalized to 1 to level dB SPL on the output channel """
+    def __init__(self, input, level, channel=0, enable=True):
+        Node.__init__(self, (input,), enable, level=level, channel=channel)
+
+    def duration(self, values):
+        return self.inputs[0].duration(values)
+
+    def scale(self, plan, values):
+        return plan.sounds.dbconvert(spl=self.get('level', values), chan=self.get('channel', values))
+
+    def make(self, plan, values, inputs):
+        return self.scale(plan, values)*inputs[0]
+
+class Gap(Node):
+    """ a shaped gap in the input, from delay for duration, on trials where cut is True """
+    def __init__(self, input, delay, duration, rf=2.5, cut=True, enable=True):
+        Node.__init__(self, (input,), enable, delay=delay, gapduration=duration, rf=rf, cut=cut)
+
+    def duration(self, values):
+        return self.inputs[0].duration(values)
+
+    def make(self, plan, values, inputs):
+        w = np.array(inputs[0])
+        if self.get('cut', values):
+            j0 = plan.offset(self.get('delay', values))
+            PySounds.envelopes.gap(w, j0, plan.offset(self.get('delay', values) +
+                                   self.get('gapduration', values)) - j0,
+                                   self.get('rf', values), plan.samplefreq)
+        return w
+
+class Sum(Node):
+    """ the inputs added, each starting at its delay (msec) """
+    def __init__(self, inputs, delays=None, enable=True):
+        if delays is None:
+            delays = len(inputs)*[0.0]
+        Node.__init__(self, inputs, enable, delays=tuple(delays))
+
+    def duration(self, values):
+        d = self.get('delays', values)
+        return max([d[i] + n.duration(values) for (i, n) in enumerate(self.inputs)] + [0.0])
+
+    def make(self, plan, values, inputs):
+        d = self.get('delays', values)
+        w = np.zeros(plan.npoints(self.duration(values)))
+        for (i, x) in enumerate(inputs):
+            j0 = plan.offset(d[i])
+            n = min(len(x), len(w) - j0)
+            if n > 0:
+                w[j0:j0+n] += x[0:n]
+        return w
+
+
+def compileGraph(outputs, sounds, samplefreq, maxduration):
+    """ the render plan for the graphs in outputs (one per channel), for stimuli
+        of up to maxduration msec """
+    return RenderPlan(outputs, sounds, samplefreq, maxduration)
+
+class RenderPlan(object):
+    def __init__(self, outputs, sounds, samplefreq, maxduration, maxcache=8):
+        self.sounds = sounds
+        self.samplefreq = samplefreq
+        self.maxcache = maxcache
+        self.cache = {} # waveforms of static sources, kept between trials
+        self.nodes = {} # signature -> the one node with that signature
+        self.refs = {} # id -> number of uses of the node
+        self.outputs = [self._merge(n) for n in outputs]
+        self.ops = []
+        for (channel, node) in enumerate(self.outputs):
+            self._lower(node, channel, [], [], [], [True])
+        self.compositor = PySounds.Compositor(self.npoints(maxduration) + 1, samplefreq,
+                                              len(self.outputs))
+        self.made = 0 # source waveforms made, for the statistics
+        self.reused = 0
+
+    def npoints(self, duration):
+        return max(int(np.floor((duration/1000.0)*self.samplefreq)), 0)
+
+    def offset(self, delay):
+        return self.npoints(delay)
+
+    def _merge(self, node):
+        """ replace node, and its inputs, by the first node seen with the same
+            signature and inputs, so that a shared subgraph is one node """
+        inputs = [self._merge(n) for n in node.inputs]
+        sig = (node.signature(), tuple([id(n) for n in inputs]))
+        m = self.nodes.get(sig)
+        if m is None:
+            node.inputs = inputs
+            m = self.nodes[sig] = node
+        self.refs[id(m)] = self.refs.get(id(m), 0) + 1
+        return m
+
+    def _lower(self, node, channel, delays, levels, enables, fresh):
+        """ turn node into compositor operations on channel. delays, levels and
+            enables are those of the enclosing Sum, Level and other nodes; fresh[0]
+            is True while nothing has been added to the channel (a gap can then be
+            cut in the channel itself, as it only holds the gap's input). """
+        enables = enables + [node.params['enable']]
+        if isinstance(node, Sum):
+            for (i, n) in enumerate(node.inputs):
+                self._lower(n, channel, delays + [node.params['delays'][i]], levels, enables, fresh)
+        elif isinstance(node, Level):
+            self._lower(node.inputs[0], channel, delays, levels + [node], enables, fresh)
+        elif isinstance(node, Gap) and fresh[0]:
+            self._lower(node.inputs[0], channel, delays, levels, enables, fresh)
+            self.ops.append(('gap', channel, node, delays, levels, enables))
+        elif not node.silent:
+            self.ops.append(('add', channel, node, delays, levels, enables))
+            fresh[0] = False
+
+    def shared(self):
+        """ the nodes used more than once """
+        return [n for n in self.nodes.values() if self.refs[id(n)] > 1]
+
+    def duration(self, values):
+        return max([n.duration(values) for n in self.outputs])
+
+    def waveform(self, node, values, memo):
+        """ the node's waveform for this trial; made once per trial (once per
+            session for static sources with the same parameters) """
+        w = memo.get(id(node))
+        if w is not None:
+            self.reused += 1
+            return w
+        if node.static:
+            key = node.key(values)
+            w = self.cache.get(key)
+            if w is None:
+                if len(self.cache) >= self.maxcache:
+                    self.cache.clear()
+                w = self.cache[key] = node.make(self, values, [])
+                self.made += 1
+            else:
+                self.reused += 1
+        else:
+            w = node.make(self, values, [self.waveform(n, values, memo) for n in node.inputs])
+            if not node.inputs:
+                self.made += 1
+        memo[id(node)] = w
+        return w
+
+    def render(self, values):
+        """ the waveforms for one trial, one per channel (views of the plan's
+            buffer, valid until the next render) """
+        comp = self.compositor
+        comp.begin(self.duration(values))
+        memo = {}
+        for (op, channel, node, delays, levels, enables) in self.ops:
+            if not all([resolve(e, values) for e in enables]):
+                continue
+            delay = sum([resolve(d, values) for d in delays])
+            if op == 'gap':
+                if node.get('cut', values):
+                    comp.gap(channel, delay + node.get('delay', values),
+                             node.get('gapduration', values), node.get('rf', values))
+                continue
+            scale = 1.0
+            for lev in levels:
+                scale *= lev.scale(self, values)
+            comp.add(channel, self.waveform(node, values, memo), delay, scale)
+        return comp.channels()
+
+    def stats(self):
+        return (self.made, self.reused)
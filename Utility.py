@@ -1,7 +1,7 @@
 """
 Utils.py - general utility routines
 - power spectrum
-- elliptical filtering
+- elliptical filtering (with a cache of filter designs), zero-phase or streaming
 - handling very long input lines for dictionaries
 
 """
@@ -28,9 +28,71 @@ Utils.py - general utility routines
 """
 
 import sys, re, os
+from collections import OrderedDict
 import scipy
+import scipy.signal
 import numpy as np
 
+# A bounded cache of iirdesign results, shared by the analysis filters here and
+# the noise synthesis in PySounds. Designs are kept in second-order-section
+# form, which stays stable for narrow bands at high sample rates (100 kHz).
+class FilterCache:
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.designs = OrderedDict() # least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def design(self, wp, ws, gpass=1.0, gstop=60.0, ftype='ellip'):
+        key = (tuple(np.atleast_1d(wp)), tuple(np.atleast_1d(ws)), gpass, gstop, ftype)
+        try:
+            sos = self.designs.pop(key)
+            self.hits += 1
+        except KeyError:
+            sos = scipy.signal.iirdesign(wp, ws, gpass=gpass, gstop=gstop,
+                                         ftype=ftype, output='sos')
+            self.misses += 1
+            if len(self.designs) >= self.maxsize:
+                self.designs.popitem(last=False) # drop the least recently used
+        self.designs[key] = sos
+        return(sos)
+
+    def bandpass(self, LPF, HPF, samplefreq, gpass=1.0, gstop=60.0):
+        """ the elliptic band-pass used for the responses, from its corners (Hz) """
+        sf2 = float(samplefreq)/2
+        wp = [float(HPF)/sf2, float(LPF)/sf2]
+        ws = [0.5*float(HPF)/sf2, 2*float(LPF)/sf2]
+        return self.design(wp, ws, gpass=gpass, gstop=gstop, ftype="ellip")
+
+    def stats(self):
+        return(self.hits, self.misses)
+
+    def clear(self):
+        self.designs.clear()
+        self.hits = 0
+        self.misses = 0
+
+filterCache = FilterCache()
+
+# Filtering a signal that arrives in chunks (e.g., as it is acquired): the
+# filter state is carried from one chunk to the next, so the result is the same
+# as filtering the whole signal at once with sosfilt. A chunk is one trace, or
+# (channels, samples); reset() before the next signal.
+class StreamingFilter:
+    def __init__(self, sos):
+        self.sos = sos
+        self.reset()
+
+    def reset(self):
+        self.zi = None
+
+    def filter(self, chunk):
+        chunk = np.asarray(chunk)
+        if self.zi is None:
+            self.zi = np.zeros((self.sos.shape[0],) + chunk.shape[:-1] + (2,))
+        (w, self.zi) = scipy.signal.sosfilt(self.sos, chunk, axis=-1, zi=self.zi)
+        return(w)
+
 # compute the power spectrum.
 # simple, no windowing etc...
 
@@ -74,25 +136,23 @@ class Utility:
         return(spectrum, freqAzero)
     
 # filter signal with elliptical filter
-    def SignalFilter(self, signal, LPF, HPF, samplefreq):
+# signal may be a single trace or a (trials, samples) array; filtering is along axis
+# (the last by default), for all the traces in one call. With zerophase, the filter
+# is run forward and backward (sosfiltfilt), so there is no phase delay to shift
+# the response latencies (and the attenuation is doubled, in dB).
+    def SignalFilter(self, signal, LPF, HPF, samplefreq, zerophase=False, axis=-1):
         if self.debugFlag:
             print "sfreq: %f LPF: %f HPF: %f" % (samplefreq, LPF, HPF)
-        flpf = float(LPF)
-        fhpf = float(HPF)
-        sf = float(samplefreq)
-        sf2 = sf/2
-        wp = [fhpf/sf2, flpf/sf2]
-        ws = [0.5*fhpf/sf2, 2*flpf/sf2]
-        if self.debugFlag:
-            print "signalfilter: samplef: %f  wp: %f, %f  ws: %f, %f lpf: %f  hpf: %f" % (
-               sf, wp[0], wp[1], ws[0], ws[1], flpf, fhpf)
-        filter_b,filter_a = scipy.signal.iirdesign(wp, ws,
-                gpass=1.0,
-                gstop=60.0,
-                ftype="ellip")
-        w = scipy.signal.lfilter(filter_b, filter_a, signal) # filter the incoming signal
+        sos = filterCache.bandpass(LPF, HPF, samplefreq)
+        if zerophase:
+            signal = np.asarray(signal)
+            ntaps = 2*sos.shape[0] + 1 - min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum())
+            padlen = min(3*ntaps, signal.shape[axis] - 1) # short traces: pad less
+            w = scipy.signal.sosfiltfilt(sos, signal, axis=axis, padlen=max(padlen, 0))
+        else:
+            w = scipy.signal.sosfilt(sos, signal, axis=axis) # filter the incoming signal
         if self.debugFlag:
-            print "sig: %f-%f w: %f-%f" % (min(signal), max(signal), min(w), max(w))
+            print "sig: %f-%f w: %f-%f" % (np.min(signal), np.max(signal), np.min(w), np.max(w))
         return(w)
         
     # do an eval on a long line (longer than 512 characters)
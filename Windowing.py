@@ -0,0 +1,42 @@
+"""
+Windowing.py - analysis windows of a session's trials, by index
+
+For a session, windowStarts gives the first point of every trial's window
+(from its delay), and gather takes all the windows from the (trials, samples)
+data in one indexing operation, rather than selecting points trial by trial.
+"""
+# Paul B. Manis, Ph.D.
+# UNC Chapel Hill
+# Department of Otolaryngology/Head and Neck Surgery
+# Supported by NIH Grants DC000425-22 and DC004551-07 to PBM.
+#
+"""
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+def windowStarts(delays, samplefreq):
+    """ first point of the window of each trial, for delays in msec """
+    srate = 1000.0/samplefreq # msec per point
+    return (np.asarray(delays, dtype=float)/srate).astype(int)
+
+def gather(data, starts, npts):
+    """ the npts point window starting at starts[i] in each row i of data
+        (trials, samples), as one (trials, npts) array; windows that run off
+        the end of the trace repeat its last point """
+    data = np.atleast_2d(data)
+    starts = np.asarray(starts, dtype=int)
+    idx = np.clip(starts[:, np.newaxis] + np.arange(npts), 0, data.shape[1] - 1)
+    return data[np.arange(data.shape[0])[:, np.newaxis], idx]
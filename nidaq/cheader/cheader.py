@@ -1,4 +1,5 @@
 import gccxmlparser, types, os, tempfile, typedesc, re, sys, ctypes
+import hashlib, cPickle
   
 def decomment(string):
   return re.sub(r'/\*.*\*/', '', re.sub(r'//.*', '', string))
@@ -140,3 +141,106 @@ def getFuncs(headerFiles):
         functions[d.name] = (getCType(d.returns), args)
 
   return functions
+
+
+## Compiled definitions cache
+## Parsing the header and the XML takes seconds; the results are saved in a
+## pickle next to the header and reused until one of the source files changes.
+## The mtime is checked first; if it differs, the file contents are hashed, so
+## a file that was only touched (or copied) does not force a new parse.
+
+CACHE_VERSION = 2
+
+def fileHash(fileName):
+  h = hashlib.md5()
+  fh = open(fileName, 'rb')
+  try:
+    while True:
+      block = fh.read(1 << 20)
+      if not block:
+        break
+      h.update(block)
+  finally:
+    fh.close()
+  return h.hexdigest()
+
+def sourceKey(fileName, hashed=True):
+  """(name, mtime, size, md5) for a source file; md5 is None if not hashed."""
+  st = os.stat(fileName)
+  md5 = None
+  if hashed:
+    md5 = fileHash(fileName)
+  return (os.path.basename(fileName), st.st_mtime, st.st_size, md5)
+
+def readCache(cacheFile, sourceFiles):
+  """Return (defs, funcs, stale) from the cache, or None if it is missing or out of date.
+  stale is True when a source's mtime changed but its contents did not."""
+  try:
+    fh = open(cacheFile, 'rb')
+    try:
+      cache = cPickle.load(fh)
+    finally:
+      fh.close()
+  except (IOError, OSError, EOFError, cPickle.UnpicklingError, AttributeError, ImportError):
+    return None
+  if type(cache) is not types.DictType or cache.get('version') != CACHE_VERSION:
+    return None
+  keys = cache.get('sources', [])
+  if len(keys) != len(sourceFiles):
+    return None
+  stale = False
+  for (sf, key) in zip(sourceFiles, keys):
+    (name, mtime, size, md5) = sourceKey(sf, hashed=False)
+    if (name, size) != (key[0], key[2]):
+      return None
+    if mtime != key[1]:
+      if fileHash(sf) != key[3]:
+        return None
+      stale = True
+  return (cache['defs'], cache['funcs'], stale)
+
+def writeCache(cacheFile, sourceFiles, defs, funcs):
+  """Save the definitions; failure to write (e.g., a read-only install) is not an error."""
+  cache = {'version': CACHE_VERSION,
+           'sources': [sourceKey(sf) for sf in sourceFiles],
+           'defs': defs, 'funcs': funcs}
+  tmpFile = cacheFile + '.tmp'
+  try:
+    fh = open(tmpFile, 'wb')
+    try:
+      cPickle.dump(cache, fh, cPickle.HIGHEST_PROTOCOL)
+    finally:
+      fh.close()
+    if os.path.exists(cacheFile):
+      os.remove(cacheFile) # rename will not replace a file on Windows
+    os.rename(tmpFile, cacheFile)
+  except (IOError, OSError), e:
+    print "cheader: could not write definitions cache %s: %s" % (cacheFile, e)
+    return False
+  return True
+
+def getCachedDefs(headerFiles, xmlFiles, cacheFile):
+  """Like getDefs(headerFiles) and getFuncs(xmlFiles) together, returning (defs, funcs),
+  but read from cacheFile when the sources have not changed since it was written."""
+  if type(headerFiles) is not types.ListType:
+    headerFiles = [headerFiles]
+  if type(xmlFiles) is not types.ListType:
+    xmlFiles = [xmlFiles]
+  sourceFiles = headerFiles + xmlFiles
+  cached = readCache(cacheFile, sourceFiles)
+  if cached is not None:
+    (defs, funcs, stale) = cached
+    if stale: # record the new mtimes so the next load does not hash again
+      writeCache(cacheFile, sourceFiles, defs, funcs)
+    return (defs, funcs)
+  defs = getDefs(headerFiles)
+  funcs = getFuncs(xmlFiles)
+  defs.pop('__builtins__', None) # put there by eval in getDefs
+  # only the values that can be saved; the rest could not be evaluated anyway
+  for k in defs.keys():
+    try:
+      cPickle.dumps(defs[k], cPickle.HIGHEST_PROTOCOL)
+    except Exception:
+      defs[k] = None
+  writeCache(cacheFile, sourceFiles, defs, funcs)
+  return (defs, funcs)
@@ -1,5 +1,5 @@
 from ctypes import *
-import sys, cheader, numpy, re, types, ctypes, os
+import sys, cheader, numpy, re, types, ctypes, os, functools
 
 int8 = c_byte
 uInt8 = c_ubyte
@@ -17,17 +17,49 @@ DAQmxEveryNSamplesEventCallbackPtr = CFUNCTYPE(int32, c_ulong, c_long, c_ulong,
 DAQmxDoneEventCallbackPtr = CFUNCTYPE(int32, c_ulong, c_long, c_void_p)
 DAQmxSignalEventCallbackPtr = CFUNCTYPE(int32, c_ulong, c_long, c_void_p)
 
+_driver = None
+## parsed NIDAQmx.h/.xml, rebuilt only when they change (see cheader.getCachedDefs)
+DEFS_CACHE = os.path.join(os.path.dirname(__file__), "NIDAQmx.defs")
+
 def init():
+  """Bind the driver: parse the headers and load the DLL. This is done once,
+  the first time the driver is used, not at import."""
+  global NIDAQ, _driver
+  if _driver is not None:
+    return _driver
   ## System-specific code
   headerFiles = [os.path.join(os.path.dirname(__file__), "NIDAQmx.h")]
   xmlFiles = [os.path.join(os.path.dirname(__file__), "NIDAQmx.xml")]
-  defs = cheader.getDefs(headerFiles)
-  global NIDAQ
-  NIDAQ = _NIDAQ()
+  (defs, functions) = cheader.getCachedDefs(headerFiles, xmlFiles, DEFS_CACHE)
+  driver = _NIDAQ()
   for k in defs:
     if k is not None:
       setattr(sys.modules[__name__], re.sub('^DAQmx_?', '', k), defs[k])
-  NIDAQ.functions = cheader.getFuncs(xmlFiles)
+  driver.functions = functions
+  _driver = driver
+  NIDAQ = driver
+  return driver
+
+class _LazyNIDAQ:
+  """Stands in for the driver wrapper until it is first used."""
+  def __getattr__(self, attr):
+    if attr[:2] == "__":
+      raise AttributeError(attr)
+    return getattr(init(), attr)
+
+  def __repr__(self):
+    return "<niDAQmx driver wrapper (not initialized)>"
+
+
+def _argType(typ, ptr):
+  """ctypes argument type for a (type name, pointer depth) from the signature.
+  Pointers other than strings are passed as void*, so byref(), array addresses
+  and None are all accepted."""
+  if ptr == 0 and typ is not None:
+    return getattr(ctypes, typ)
+  if ptr == 1 and typ == 'c_char':
+    return c_char_p
+  return c_void_p
 
 
 class NIDAQError(Exception):
@@ -56,53 +88,54 @@ class _NIDAQ:
   
   def __getattr__(self, attr):
     if attr[0] != "_" and hasattr(self.nidaq, 'DAQmx' + attr):
-      return lambda *args: self.call(attr, *args)
+      func = self.bind(attr)
+      setattr(self, attr, func) # later lookups find the binding directly
+      return func
     else:
       raise NameError(attr)
 
-  def call(self, func, *args):
-    func = 'DAQmx' + func
-    ret = None
+  def bind(self, attr):
+    """Build the typed binding for DAQmx<attr>: the ctypes function gets its
+    argtypes, restype and an errcheck hook from the signature in the header, so
+    calls convert their arguments and check the error code in ctypes itself.
+    Get functions (and IsTaskDone) return the value read instead of True."""
+    func = 'DAQmx' + attr
     retType, argSig = self.functions[func]
-    #print "CALL: ", func, args, argSig
-    
-    if func[:8] == "DAQmxGet":
-      if argSig[-1][0] == 'data':
-        ret = getattr(ctypes, argSig[-1][1])()
-        args += (byref(ret),)
+    cfunc = self._typed(getattr(self.nidaq, func), argSig)
+    cfunc.errcheck = self._errcheck
+    if func[:8] == "DAQmxGet" or func == "DAQmxIsTaskDone":
+      if argSig[-1][0] in ['data', 'isTaskDone']:
+        valueType = getattr(ctypes, argSig[-1][1])
+        def getValue(*args):
+          ret = valueType()
+          cfunc(*(args + (byref(ret),)))
+          return ret.value
+        return getValue
       elif argSig[-2][1:] == ('c_char', 1) and argSig[-1][1:] in [('c_ulong', 0), ('c_long', 0)]:
-        #print "correct for buffer return"
-        tmpargs = args + (getattr(ctypes, argSig[-2][1])(), getattr(ctypes, argSig[-1][1])())
-        buffSize = self._call(func, *tmpargs)
-        ret = create_string_buffer('\0' * buffSize)
-        args += (ret, buffSize)
-    
-    cArgs = []
-    for i in range(0, len(args)):
-      arg = args[i]
-      if type(args[i]) in [types.FloatType, types.IntType, types.LongType, types.BooleanType] and argSig[i][2] == 0:
-        #print func, i, argSig[i][0], argSig[i][1], type(arg)
-        arg = getattr(ctypes, argSig[i][1])(arg)
-      cArgs.append(arg)
-    
-    #print "  FINAL CALL: ", cArgs
-    errCode = self._call(func, *cArgs)
+        # a string: the first call (unchecked) returns the buffer size needed
+        sizeFunc = self._typed(self.nidaq[func], argSig)
+        def getString(*args):
+          buffSize = sizeFunc(*(args + (None, 0)))
+          ret = create_string_buffer('\0' * buffSize)
+          cfunc(*(args + (ret, buffSize)))
+          return ret.value
+        return getString
+    return cfunc
+
+  def _typed(self, cfunc, argSig):
+    cfunc.argtypes = [_argType(typ, ptr) for (name, typ, ptr) in argSig]
+    cfunc.restype = int32
+    return cfunc
+
+  def _errcheck(self, errCode, cfunc, args):
     if errCode < 0:
-      raise NIDAQError(errCode, "Function '%s%s'" % (func, str(args)), *self.error(errCode))
+      raise NIDAQError(errCode, "Function '%s%s'" % (cfunc.__name__, str(args)), *self.error(errCode))
     elif errCode > 0:
-      raise NIDAQWarning(errCode, "Function '%s%s'" % (func, str(args)), *self.error(errCode))
-    
-    if ret is None:
-      return True
-    else:
-      return ret.value
-    
-  def _call(self, func, *args):
-    try:
-      return getattr(self.nidaq, func)(*args)
-    except:
-      print func, args
-      raise
+      raise NIDAQWarning(errCode, "Function '%s%s'" % (cfunc.__name__, str(args)), *self.error(errCode))
+    return True
+
+  def call(self, func, *args):
+    return getattr(self, func)(*args)
     
   def error(self, errCode):
     return (self.GetErrorString(errCode),
@@ -114,6 +147,8 @@ class _NIDAQ:
 class Device:
   def __init__(self, dev, nidaq):
     self.dev = dev
+    if isinstance(nidaq, _LazyNIDAQ):
+      nidaq = init() # hold the driver itself, so calls do not go through the proxy
     self.nidaq = nidaq
 
   def createTask(self, taskName=""):
@@ -158,8 +193,9 @@ class Task:
     self.nidaq.ClearTask(self.handle)
 
   def __getattr__(self, attr):
-    func = getattr(self.nidaq, attr)
-    return lambda *args: func(self.handle, *args)
+    func = functools.partial(getattr(self.nidaq, attr), self.handle)
+    setattr(self, attr, func) # bind once per task
+    return func
 
   #def addChannel(self, channelType, *args):
     #"""channelType must be named to fit the API for their channel creation functions."""
@@ -175,7 +211,9 @@ class Task:
     self.nidaq.StopTask(self.handle)
 
   def isDone(self):
-    return self.nidaq.IsTaskDone(self.handle)
+    return bool(self.nidaq.IsTaskDone(self.handle))
+
+  isTaskDone = isDone
 
   def read(self, samples=None, timeout=10.):
     if samples is None:
@@ -195,4 +233,4 @@ class Task:
     self.WriteAnalogF64(data.size / numChans, False, timeout, Val_GroupByChannel, data.ctypes.data, byref(samplesWritten), None)
     return samplesWritten.value
 
-init()
+NIDAQ = _LazyNIDAQ()